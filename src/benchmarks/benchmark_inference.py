@@ -0,0 +1,110 @@
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path.cwd() / "src"))
+
+from argparse import ArgumentParser
+from time import perf_counter
+
+import cv2
+import numpy as np
+
+from cv.board import GetChessboardOnlyResultType, board_segment_ncnn_path, \
+    board_segment_stem, get_chessboard_only
+from cv.inference import BACKENDS, Classifier, Segmenter, read_model_metadata
+from cv.models import YOLOModelLoader, models_path
+from cv.pieces import get_square_batch, piece_classify_ncnn_path, piece_classify_stem
+
+parser = ArgumentParser(description="Compare running the models through ultralytics "
+                                    "with running them directly with an inference "
+                                    "backend, on the test image directories.")
+parser.add_argument("-t", "--test-dir", type=Path, default=Path.cwd() / "test",
+                    help="Directory containing the directories of test images.")
+parser.add_argument("-r", "--repeat", type=int, default=3,
+                    help="How many times to run the models on each image.")
+parser.add_argument("-b", "--backend", choices=list(BACKENDS), default="ncnn",
+                    help="Inference backend to run the models directly with. "
+                         "Defaults to ncnn.")
+parser.add_argument("--threads", type=int, default=None,
+                    help="Number of threads the backend runs the models with. "
+                         "Defaults to the backend's default.")
+args = parser.parse_args()
+print(args)
+
+yolo_segmenter = YOLOModelLoader(board_segment_ncnn_path, task="segment",
+                                 warm_up_shape=(606, 800, 3)).model
+yolo_classifier = YOLOModelLoader(piece_classify_ncnn_path, task="classify",
+                                  warm_up_shape=(64, 64, 3), imgsz=64).model
+backend = BACKENDS[args.backend]
+direct_segmenter = Segmenter(
+    backend(backend.model_path(models_path, board_segment_stem), args.threads),
+    read_model_metadata(board_segment_ncnn_path))
+direct_classifier = Classifier(
+    backend(backend.model_path(models_path, piece_classify_stem), args.threads),
+    read_model_metadata(piece_classify_ncnn_path))
+
+frames = [cv2.flip(cv2.imread(str(image_path)), 1)
+          for image_path in sorted(Path(args.test_dir).glob("*/*.jpg"))]
+print(f"Loaded {len(frames)} images")
+direct_segmenter.warm_up(frames[0].shape)
+direct_classifier.warm_up()
+
+
+def outline_mask(outline: np.ndarray, shape: tuple) -> np.ndarray:
+    mask = np.zeros(shape[:2], dtype=np.uint8)
+    cv2.fillPoly(mask, [outline.astype(np.int32)], 1)
+    return mask
+
+
+def classify_with_yolo(cb_only: np.ndarray) -> np.ndarray:
+    tiles = [cb_only[i * 64:(i + 1) * 64, j * 64:(j + 1) * 64]
+             for i in range(8) for j in range(8)]
+    return np.array([yolo_classifier(tile, imgsz=64, verbose=False)[0]
+                    .probs.data.cpu().numpy() for tile in tiles])
+
+
+timings = {"segment ultralytics": [], f"segment {args.backend}": [],
+           "classify ultralytics": [], f"classify {args.backend}": []}
+ious = []
+agreements = []
+for frame in frames:
+    for _ in range(args.repeat):
+        start = perf_counter()
+        results = yolo_segmenter(frame, verbose=False)
+        timings["segment ultralytics"].append(perf_counter() - start)
+
+        start = perf_counter()
+        outline = direct_segmenter.segment(frame)
+        timings[f"segment {args.backend}"].append(perf_counter() - start)
+    yolo_outline = results[0].masks.xy[0] if results[0].masks is not None else None
+    if yolo_outline is not None and outline is not None:
+        yolo_mask = outline_mask(yolo_outline, frame.shape)
+        mask = outline_mask(outline, frame.shape)
+        ious.append(np.sum(yolo_mask & mask) / max(np.sum(yolo_mask | mask), 1))
+    elif (yolo_outline is None) != (outline is None):
+        ious.append(0)
+
+    result = get_chessboard_only(frame)
+    if result.result_type != GetChessboardOnlyResultType.CHESSBOARD_FOUND:
+        continue
+    cb_only = result.chessboard
+    for _ in range(args.repeat):
+        start = perf_counter()
+        yolo_probs = classify_with_yolo(cb_only)
+        timings["classify ultralytics"].append(perf_counter() - start)
+
+        start = perf_counter()
+        probs = direct_classifier.classify(get_square_batch(cb_only))
+        timings[f"classify {args.backend}"].append(perf_counter() - start)
+    agreements.append(np.mean(yolo_probs.argmax(axis=1) == probs.argmax(axis=1)))
+
+for name, times in timings.items():
+    times_ms = np.array(times) * 1000
+    print(f"{name:>22}: mean {times_ms.mean():.2f} ms, median "
+          f"{np.median(times_ms):.2f} ms, p95 {np.percentile(times_ms, 95):.2f} ms")
+for task in ("segment", "classify"):
+    speedup = np.mean(timings[f"{task} ultralytics"]) / \
+        np.mean(timings[f"{task} {args.backend}"])
+    print(f"{task} speedup: {speedup:.2f}x")
+print(f"Segmentation mask IoU: mean {np.mean(ious):.4f}, min {np.min(ious):.4f}")
+print(f"Classification top-1 agreement: {np.mean(agreements) * 100:.2f}%")
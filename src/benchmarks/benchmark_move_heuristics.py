@@ -0,0 +1,73 @@
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path.cwd() / "src"))
+
+import random
+from argparse import ArgumentParser
+from time import perf_counter
+
+import chess
+
+from benchmarks.legacy_move_heuristics import LegacyMoveHeuristics
+from chessbot_move_heuristics import ChessbotMoveHeuristics
+from utils.chess_stuff import board_to_arrangement, find_chessboard_differences
+
+parser = ArgumentParser(description="Compare the move index with the old cascade of "
+                                    "heuristics on synthetic differences.")
+parser.add_argument("-g", "--games", type=int, default=50,
+                    help="Number of random games to generate positions from.")
+parser.add_argument("-c", "--candidates", type=int, default=10,
+                    help="Number of candidate differences tried per position, like "
+                         "the candidate arrangements tried every frame.")
+parser.add_argument("-f", "--frames", type=int, default=5,
+                    help="Number of frames seen per position before the move lands.")
+parser.add_argument("-s", "--seed", type=int, default=0,
+                    help="Random seed.")
+args = parser.parse_args()
+print(args)
+
+random.seed(args.seed)
+
+# Every position gets the differences of its real next move, and the differences of
+# random legal moves from other positions as the wrong candidates
+positions = []
+for _ in range(args.games):
+    board = chess.Board()
+    while not board.is_game_over() and board.ply() < 200:
+        move = random.choice(list(board.legal_moves))
+        after = board.copy(stack=False)
+        after.push(move)
+        positions.append((board.copy(), move,
+                          find_chessboard_differences(board_to_arrangement(board),
+                                                      board_to_arrangement(after))))
+        board.push(move)
+all_differences = [diffs for _, _, diffs in positions]
+# Wrong candidates first, then the real move on the last frame
+candidates = [random.sample(all_differences, args.frames * args.candidates - 1) +
+              [diffs] for _, _, diffs in positions]
+print(f"Generated {len(positions)} positions")
+
+results = {}
+for name in ("cascade", "index"):
+    elapsed = 0
+    lookups = 0
+    found = 0
+    for (board, move, _), position_candidates in zip(positions, candidates):
+        heuristics = LegacyMoveHeuristics(board) if name == "cascade" \
+            else ChessbotMoveHeuristics(board)
+        result = None
+        start = perf_counter()
+        for candidate in position_candidates:
+            lookups += 1
+            result = heuristics.try_update_board(candidate)
+            if result is not None:
+                break
+        elapsed += perf_counter() - start
+        if result is not None:
+            found += board.pop() == move
+    results[name] = elapsed
+    print(f"{name}: {lookups / elapsed:.0f} lookups/s, {elapsed * 1000:.1f} ms "
+          f"total, found {found}/{len(positions)} moves")
+
+print(f"Speedup: {results['cascade'] / results['index']:.2f}x")
@@ -0,0 +1,72 @@
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path.cwd() / "src"))
+
+from argparse import ArgumentParser
+from time import perf_counter
+
+import cv2
+import numpy as np
+
+from cv.board import GetChessboardOnlyResultType, get_chessboard_only
+from cv.models import YOLOModelLoader
+from cv.pieces import classify_squares, piece_classify_ncnn_path
+from utils.cv2_stuff import get_tile_in_image
+
+parser = ArgumentParser(description="Compare per-square and batched piece "
+                                    "classification on the test image directories.")
+parser.add_argument("-t", "--test-dir", type=Path, default=Path.cwd() / "test",
+                    help="Directory containing the directories of test images.")
+parser.add_argument("-r", "--repeat", type=int, default=3,
+                    help="How many times to classify each board.")
+args = parser.parse_args()
+print(args)
+
+yolo_loader = YOLOModelLoader(piece_classify_ncnn_path, task="classify",
+                              warm_up_shape=(64, 64, 3), imgsz=64)
+
+
+def classify_squares_per_square(cb_only: np.ndarray) -> np.ndarray:
+    # The old path, one ultralytics call per square
+    return np.array([
+        yolo_loader.model(get_tile_in_image(cb_only, i // 8, i % 8), imgsz=64,
+                          verbose=False)[0].probs.data.cpu().numpy()
+        for i in range(64)
+    ])
+
+
+boards = []
+for image_path in sorted(Path(args.test_dir).glob("*/*.jpg")):
+    frame = cv2.flip(cv2.imread(str(image_path)), 1)
+    result = get_chessboard_only(frame)
+    if result.result_type == GetChessboardOnlyResultType.CHESSBOARD_FOUND:
+        boards.append(result.chessboard)
+print(f"Found a chessboard in {len(boards)} images")
+
+# Warm up both paths so model loading is not timed
+classify_squares_per_square(boards[0])
+classify_squares(boards[0])
+
+before_times = []
+after_times = []
+agreements = []
+for cb_only in boards:
+    for _ in range(args.repeat):
+        start = perf_counter()
+        before = classify_squares_per_square(cb_only)
+        before_times.append(perf_counter() - start)
+
+        start = perf_counter()
+        after = classify_squares(cb_only)
+        after_times.append(perf_counter() - start)
+    agreements.append(np.mean(before.argmax(axis=1) == after.argmax(axis=1)))
+
+before_ms = np.array(before_times) * 1000
+after_ms = np.array(after_times) * 1000
+print(f"Per-square: mean {before_ms.mean():.2f} ms, median {np.median(before_ms):.2f} "
+      f"ms per board")
+print(f"Batched: mean {after_ms.mean():.2f} ms, median {np.median(after_ms):.2f} ms "
+      f"per board")
+print(f"Speedup: {before_ms.mean() / after_ms.mean():.2f}x")
+print(f"Top-1 agreement: {np.mean(agreements) * 100:.2f}%")
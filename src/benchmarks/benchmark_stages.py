@@ -0,0 +1,134 @@
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path.cwd() / "src"))
+
+import json
+import platform
+from argparse import ArgumentParser
+from datetime import datetime
+from time import perf_counter
+
+import chess.pgn
+import cv2
+import numpy as np
+
+from chessbot import Chessbot
+from utils.fake_picamera2 import FakePicamera2
+
+parser = ArgumentParser(description="Replay the test games through the chessbot and "
+                                    "measure the latency of every stage.")
+parser.add_argument("image_dirs", type=Path, nargs="*",
+                    help="Directories of images to replay. Defaults to every "
+                         "directory in test.")
+parser.add_argument("-o", "--output", type=Path, default=None,
+                    help="Where to save the results as JSON. Defaults to "
+                         "benchmark_stages_<date>.json.")
+parser.add_argument("-r", "--repeats", type=int, default=1,
+                    help="Number of times to replay every directory.")
+parser.add_argument("--legal-move-decoding", action="store_true",
+                    help="Decode moves by scoring every legal move against the piece "
+                         "classifier.")
+parser.add_argument("--no-track-board", action="store_true",
+                    help="Segment the board on every frame.")
+parser.add_argument("--no-cache-pieces", action="store_true",
+                    help="Classify all squares on every frame.")
+parser.add_argument("--save-expected", action="store_true",
+                    help="Save the replayed games as the expected games of "
+                         "directories that have none yet. Check them first!")
+args = parser.parse_args()
+print(args)
+
+image_dirs = args.image_dirs or sorted(p for p in (Path.cwd() / "test").iterdir()
+                                       if p.is_dir())
+output = args.output or \
+         Path(f"benchmark_stages_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+
+stage_timings: dict[str, list[float]] = {}
+frame_timings = []
+games = {}
+
+for image_dir in image_dirs:
+    cam = FakePicamera2(image_dir)
+    cam.start()
+    for repeat in range(args.repeats):
+        chessbot = Chessbot(legal_move_decoding=args.legal_move_decoding,
+                            track_board=not args.no_track_board,
+                            cache_pieces=not args.no_cache_pieces,
+                            annotate_camera_preview=False, use_engine=False)
+        for i in range(cam.max_image_index + 1):
+            cam.image_index = i
+            frame = cv2.flip(cam.capture_array(), 1)  # Flip horizontally, like main
+
+            start = perf_counter()
+            chessbot.update(frame)
+            elapsed = perf_counter() - start
+
+            # The first frame also loads and warms up the models
+            if repeat == 0 and i == 0 and image_dir == image_dirs[0]:
+                continue
+            frame_timings.append(elapsed)
+            for stage, seconds in chessbot.stage_timings.items():
+                stage_timings.setdefault(stage, []).append(seconds)
+        chessbot.quit()
+
+    board = chessbot.board_snapshot
+    moves = [move.uci() for move in board.move_stack]
+    expected_path = image_dir / "expected.pgn"
+    expected = None
+    if expected_path.exists():
+        with open(expected_path) as f:
+            expected = [move.uci() for move in chess.pgn.read_game(f).mainline_moves()]
+    elif args.save_expected:
+        game = chess.pgn.Game.from_board(board)
+        game.headers["Event"] = image_dir.name
+        with open(expected_path, "w") as f:
+            print(game, file=f)
+        print(f"Saved expected game of {image_dir.name} to {expected_path}")
+    games[image_dir.name] = {
+        "frames": cam.max_image_index + 1,
+        "moves": moves,
+        "expected": expected,
+        "matches": moves == expected if expected is not None else None
+    }
+    status = "no expected game" if expected is None else \
+        "matches" if moves == expected else "DOES NOT MATCH"
+    print(f"{image_dir.name}: {len(moves)} moves, {status}")
+
+
+def summarize(timings: list[float]) -> dict:
+    return {
+        "count": len(timings),
+        "mean_ms": float(np.mean(timings) * 1000),
+        "p50_ms": float(np.percentile(timings, 50) * 1000),
+        "p95_ms": float(np.percentile(timings, 95) * 1000),
+        "p99_ms": float(np.percentile(timings, 99) * 1000)
+    }
+
+
+results = {
+    "date": datetime.now().isoformat(),
+    "machine": platform.machine(),
+    "python": platform.python_version(),
+    "args": {key: str(value) if isinstance(value, Path) else value
+             for key, value in vars(args).items() if key != "image_dirs"},
+    "fps": len(frame_timings) / sum(frame_timings) if frame_timings else 0,
+    "end_to_end": summarize(frame_timings) if frame_timings else None,
+    "stages": {stage: summarize(timings) for stage, timings in stage_timings.items()},
+    "games": games
+}
+
+print(f"{'stage':>12} {'count':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+for stage, summary in list(results["stages"].items()) + \
+        [("end to end", results["end_to_end"])]:
+    if summary is None:
+        continue
+    print(f"{stage:>12} {summary['count']:>6} {summary['p50_ms']:>8.2f} "
+          f"{summary['p95_ms']:>8.2f} {summary['p99_ms']:>8.2f}")
+print(f"End to end: {results['fps']:.1f} FPS")
+matched = [game["matches"] for game in games.values() if game["matches"] is not None]
+print(f"Reproduced {sum(matched)}/{len(matched)} expected games")
+
+with open(output, "w") as f:
+    json.dump(results, f, indent=2)
+print(f"Saved results to {output}")
@@ -1,21 +1,29 @@
 import logging
 from enum import Enum
+from pathlib import Path
+from time import perf_counter
+from typing import Optional
 
 import chess
-import chess.engine
-import chess.pgn
-import chess.svg
 import numpy as np
 
+from chessbot_move_decoder import ChessbotMoveDecoder
 from chessbot_move_heuristics import ChessbotMoveHeuristics
-from cv.board import GetChessboardOnlyResultType, get_chessboard_only
-from cv.pieces import get_piece_matrix
+from cv.board import ChessboardTracker, GetChessboardOnlyResultType, \
+    get_chessboard_only
+from cv.motion import MotionGate, MotionGateMetrics, MotionGateResultType
+from cv.pieces import PieceClassificationCache, PieceClassificationCacheMetrics, \
+    classify_squares, get_piece_matrix, piece_model_loader
 from utils.chess_stuff import board_sync_from_chessboard_arrangement, \
-    find_chessboard_differences
+    board_to_arrangement, find_chessboard_differences
 # from utils.chess_stuff import board_sync_from_chessboard_arrangement
-from utils.cv2_stuff import svg_to_numpy, write_text
-from utils.engine_stuff import find_stockfish_binary
+from utils.board_render_stuff import BoardPreviewRenderer
+from utils.cv2_stuff import PerspectiveWarper, write_text
+from utils.engine_stuff import EngineAnalysisService, EngineEvaluationCache, \
+    EngineEvaluationCacheMetrics, EngineSuggestion, PositionLookup, \
+    find_opening_book, find_stockfish_binary, find_syzygy_tablebases
 from utils.logger import create_logger
+from utils.metrics_stuff import Counter, Histogram, MetricsRegistry
 
 logger = create_logger(name=__name__, level=logging.DEBUG)
 
@@ -28,23 +36,155 @@ class ChessbotFrameUpdateResult(Enum):
     OBSTRUCTED_SQUARES = "OBSTRUCTED_SQUARES"
     ILLEGAL_MOVE = "ILLEGAL_MOVE"
     NO_CHANGE = "NO_CHANGE"
+    MOTION = "MOTION"
 
 
-class Chessbot:
+# Which metric every stage of an update is recorded under
+STAGE_METRICS = {
+    "motion_gate": "motion_gate",
+    "board": "segmentation",
+    "classify": "classification",
+    "decode": "heuristics",
+    "pieces": "heuristics",
+    "differences": "heuristics",
+    "move": "heuristics",
+    "catch_up": "heuristics",
+    "engine": "engine",
+    "preview": "render"
+}
+
+
+class ChessbotMetrics:
     def __init__(self):
+        """
+        Latency histograms and result counters of a chessbot, cheap enough to
+        record on every frame.
+        """
+        self.registry = MetricsRegistry()
+        self._stage_seconds = self.registry.register(Histogram(
+            "chessbot_stage_seconds", "Time spent in each stage of a frame update.",
+            "stage"))
+        self._update_seconds = self.registry.register(Histogram(
+            "chessbot_update_seconds", "Time spent on a frame update by its result.",
+            "result"))
+        self._results = self.registry.register(Counter(
+            "chessbot_frame_results_total", "Number of frame updates by their result.",
+            "result", [result.value for result in ChessbotFrameUpdateResult]))
+
+    def record(self, result: ChessbotFrameUpdateResult, seconds: float,
+               stage_timings: dict[str, float]):
+        """
+        Record a frame update.
+
+        :param result: The result of the update.
+        :param seconds: How long the whole update took.
+        :param stage_timings: How long each stage of the update took, like
+         Chessbot.stage_timings.
+        """
+        metric_seconds: dict[str, float] = {}
+        for stage, stage_seconds in stage_timings.items():
+            metric = STAGE_METRICS.get(stage, stage)
+            metric_seconds[metric] = metric_seconds.get(metric, 0) + stage_seconds
+        for metric, stage_seconds in metric_seconds.items():
+            self._stage_seconds.observe(metric, stage_seconds)
+        self._update_seconds.observe(result.value, seconds)
+        self._results.inc(result.value)
+
+
+preview_renderer: Optional[BoardPreviewRenderer] = None
+
+
+def get_chessboard_preview(board: chess.Board) -> np.ndarray:
+    """
+    Render a board with its last move and check highlighted.
+
+    :param board: The board to render.
+    :return: A 512x512 image of the board.
+    """
+    global preview_renderer
+    if preview_renderer is None:
+        preview_renderer = BoardPreviewRenderer(size=512)
+    return preview_renderer.render(board)
+
+
+class Chessbot:
+    def __init__(self, legal_move_decoding: bool = False,
+                 min_decoding_margin: float = 2.0, catch_up_max_plies: int = 3,
+                 catch_up_time_budget: float = 0.05, track_board: bool = True,
+                 motion_gate: Optional[MotionGate] = None, cache_pieces: bool = True,
+                 render_chessboard_preview: bool = True,
+                 annotate_camera_preview: bool = True, use_engine: bool = True,
+                 engine_cache_path: Optional[Path] = None,
+                 record_metrics: bool = True):
+        """
+        Create a chessbot.
+
+        :param legal_move_decoding: Decode moves by scoring every legal move against
+         the piece classifier's probabilities, instead of matching the most confident
+         arrangements against the board.
+        :param min_decoding_margin: When decoding legal moves, how much more likely
+         (as a log likelihood ratio) the best move must be than the runner-up to be
+         accepted.
+        :param catch_up_max_plies: When no single move matches a frame, the maximum
+         number of moves to search for in case frames with moves were missed. 1 or
+         less disables catching up.
+        :param catch_up_time_budget: Maximum time in seconds to spend catching up per
+         frame.
+        :param track_board: Reuse the last board segmentation while the board has not
+         moved, instead of segmenting every frame.
+        :param motion_gate: If given, only run the pipeline on frames where the scene
+         has settled and changed since the last processed frame. Only useful for
+         continuous camera input.
+        :param cache_pieces: Only classify the squares whose pixels changed since they
+         were last classified.
+        :param render_chessboard_preview: Render the chessboard preview on every
+         update. Turn off to render it elsewhere from board_snapshot.
+        :param annotate_camera_preview: Show the classes of the squares on the camera
+         preview. Turn off when the preview is not shown.
+        :param use_engine: Analyse the game with Stockfish, if it can be found.
+        :param engine_cache_path: If given, store engine evaluations in a database at
+         this path, so positions that come up again are not searched from scratch.
+        :param record_metrics: Record stage latency histograms and result counters,
+         to serve with a MetricsServer from metrics_registry.
+        """
         self._board = chess.Board()
         self._move_heuristics = ChessbotMoveHeuristics(self._board)
+        self._legal_move_decoding = legal_move_decoding
+        self._min_decoding_margin = min_decoding_margin
+        self._catch_up_max_plies = catch_up_max_plies
+        self._catch_up_time_budget = catch_up_time_budget
+        self._board_tracker = ChessboardTracker() if track_board else None
+        self._warper = PerspectiveWarper() if not track_board else None
+        self._motion_gate = motion_gate
+        self._piece_cache = PieceClassificationCache() if cache_pieces else None
+        self._render_chessboard_preview = render_chessboard_preview
+        self._annotate_camera_preview = annotate_camera_preview
+        self._move_decoder = ChessbotMoveDecoder(self._board, piece_model_loader.names)
 
-        sf_path = find_stockfish_binary()
+        sf_path = find_stockfish_binary() if use_engine else None
         if sf_path is not None:
             logger.debug(f"Using stockfish binary at {sf_path}")
-            self._engine = chess.engine.SimpleEngine.popen_uci(str(sf_path))
+            self._engine_cache = EngineEvaluationCache(engine_cache_path) \
+                if engine_cache_path is not None else None
+            book_path = find_opening_book()
+            tablebase_path = find_syzygy_tablebases()
+            self._position_lookup = PositionLookup(book_path, tablebase_path) \
+                if book_path is not None or tablebase_path is not None else None
+            self._engine = EngineAnalysisService(sf_path, cache=self._engine_cache,
+                                                 lookup=self._position_lookup)
+            self._engine.set_position(self._board)
         else:
-            logger.warning("Could not find stockfish binary, engine will not be used")
+            if use_engine:
+                logger.warning("Could not find stockfish binary, engine will not be "
+                               "used")
+            self._engine_cache = None
+            self._position_lookup = None
             self._engine = None
 
         self._camera_preview = None
         self._chessboard_preview = None
+        self._stage_timings: dict[str, float] = {}
+        self._metrics = ChessbotMetrics() if record_metrics else None
 
         logger.debug("Chessbot created")
 
@@ -53,37 +193,36 @@ class Chessbot:
         Quit the chessbot and release all resources.
         """
         if self._engine is not None:
-            self._engine.close()
+            self._engine.quit()
             logger.debug("Chessbot engine quit")
+            if self._engine_cache is not None:
+                self._engine_cache.close()
+            if self._position_lookup is not None:
+                self._position_lookup.close()
         else:
             logger.debug("Chessbot engine not used, nothing to quit")
         logger.debug("Chessbot destroyed")
 
     def _get_game_pgn_preview(self) -> str:
+        # Importing chess.pgn also imports chess.engine and asyncio
+        import chess.pgn
+
         pgn_game = chess.pgn.Game.from_board(self._board)
         exporter = chess.pgn.StringExporter(headers=False)
         return pgn_game.accept(exporter)
 
     def _get_chessboard_preview(self) -> np.ndarray:
-        # Find the last move and highlight it
-        last_move = self._board.peek() if len(self._board.move_stack) > 0 else None
-        # Find which king is in check
-        fill = {}
-        checkers = self._board.checkers()
-        if checkers:
-            # Get a piece that is checking the king (although multiple checkers are
-            # possible, they should all be the same color)
-            a_checking_piece = self._board.piece_at(checkers.pop())
-            side_in_check = not a_checking_piece.color
-            # Get the king that is in check
-            check_square = self._board.king(side_in_check)
-            fill[check_square] = "#CC0000CC"
-        return svg_to_numpy(
-            chess.svg.board(self._board, size=512, lastmove=last_move,
-                            # check=check_square  # svglib does not like the gradient used for check
-                            # so we use fill
-                            fill=fill)
-        )
+        return get_chessboard_preview(self._board)
+
+    def _record_stage(self, name: str, start: float):
+        """
+        Add the time since start to a stage of the current update.
+
+        :param name: The name of the stage.
+        :param start: perf_counter() time the stage started at.
+        """
+        self._stage_timings[name] = self._stage_timings.get(name, 0) + \
+            perf_counter() - start
 
     def update(self, frame: np.ndarray,
                force_board_sync: bool = False) -> ChessbotFrameUpdateResult:
@@ -95,11 +234,42 @@ class Chessbot:
          does not represent a valid move. Useful for starting in the middle of a game.
         :return: The result of the update.
         """
+        start = perf_counter()
+        update_result = self._update(frame, force_board_sync)
+        if self._metrics is not None:
+            self._metrics.record(update_result, perf_counter() - start,
+                                 self._stage_timings)
+        return update_result
+
+    def _update(self, frame: np.ndarray,
+                force_board_sync: bool) -> ChessbotFrameUpdateResult:
+        self._stage_timings = {}
+
+        # Skip the pipeline while nothing changed or something is still moving
+        if self._motion_gate is not None and not force_board_sync:
+            stage_start = perf_counter()
+            gate_result = self._motion_gate.check(frame)
+            self._record_stage("motion_gate", stage_start)
+            if gate_result == MotionGateResultType.UNCHANGED:
+                return ChessbotFrameUpdateResult.NO_CHANGE
+            elif gate_result == MotionGateResultType.MOTION:
+                self._camera_preview = frame.copy()
+                write_text(self._camera_preview, "Waiting for motion to stop", 10, 10)
+                if self._render_chessboard_preview and \
+                        self._chessboard_preview is None:
+                    self._chessboard_preview = self._get_chessboard_preview()
+                return ChessbotFrameUpdateResult.MOTION
+
         update_result = ChessbotFrameUpdateResult.OK
         self._camera_preview = frame.copy()
 
         # Use ML model to segment the board
-        result = get_chessboard_only(frame)
+        stage_start = perf_counter()
+        if self._board_tracker is not None:
+            result = self._board_tracker.get_chessboard_only(frame)
+        else:
+            result = get_chessboard_only(frame, warper=self._warper)
+        self._record_stage("board", stage_start)
         cb_only = None
         if result.result_type == GetChessboardOnlyResultType.CHESSBOARD_FOUND:
             cb_only = result.chessboard
@@ -115,29 +285,62 @@ class Chessbot:
                        10)
             update_result = ChessbotFrameUpdateResult.NOT_RECTANGULAR_ENOUGH
 
-        # Use ML model to classify each square and get a chessboard arrangement
+        # Use ML model to classify each square, reusing squares that did not change
+        probs = None
         if cb_only is not None:
+            stage_start = perf_counter()
+            if self._piece_cache is not None:
+                probs = self._piece_cache.classify_squares(cb_only, result.perspective)
+            else:
+                probs = classify_squares(cb_only)
+            self._record_stage("classify", stage_start)
+
+        # Decode the most likely legal move from the classifications
+        if cb_only is not None and self._legal_move_decoding and not force_board_sync:
+            stage_start = perf_counter()
+            decoded = self._move_decoder.decode(probs)
+            self._record_stage("decode", stage_start)
+            write_text(self._camera_preview,
+                       f"{decoded.move or 'No move'} ({decoded.margin:.2f})", 10, 10)
+            if decoded.margin < self._min_decoding_margin:
+                if np.any(probs.argmax(axis=1) == self._move_decoder.occluded_class):
+                    update_result = ChessbotFrameUpdateResult.OBSTRUCTED_SQUARES
+                else:
+                    update_result = ChessbotFrameUpdateResult.ILLEGAL_MOVE
+            elif decoded.move is None:
+                update_result = ChessbotFrameUpdateResult.NO_CHANGE
+            else:
+                self._board.push(decoded.move)
+        # Or get the most confident chessboard arrangements from them
+        elif cb_only is not None:
+            stage_start = perf_counter()
             results = get_piece_matrix(cb_only, top_n_confident=10,
-                                       return_annotations=True)
+                                       return_annotations=self._annotate_camera_preview,
+                                       probs=probs)
+            self._record_stage("pieces", stage_start)
             # for i, r in enumerate(results):
             #     print(
-            #         f"Chessboard detection result {i}: ({r.confidence})\n{r.pieces}\n")
+            #         f"Chessboard detection result {i}:\n{r}\n")
             if force_board_sync:
                 # logger.info("Forcing board sync from chessboard arrangement")
                 board_sync_from_chessboard_arrangement(self._board, results[0].pieces)
             else:
+                board_arrangement = board_to_arrangement(self._board)
+                unmatched_diffs = []
                 for i, result in enumerate(results):
                     # logger.debug(f"Trying update with possible result {i}")
-                    self._camera_preview = result.annotation
-                    write_text(self._camera_preview, f"{result.confidence:.4f}", 10, 10)
                     try:
-                        diffs = find_chessboard_differences(str(self._board),
+                        stage_start = perf_counter()
+                        diffs = find_chessboard_differences(board_arrangement,
                                                             result.pieces)
+                        self._record_stage("differences", stage_start)
                         if len(diffs) == 0:
                             # logger.debug("No differences in board found, skipping")
                             update_result = ChessbotFrameUpdateResult.NO_CHANGE
                             break
+                        stage_start = perf_counter()
                         move = self._move_heuristics.try_update_board(diffs)
+                        self._record_stage("move", stage_start)
                     except ValueError:
                         # logger.debug(
                         #     "Unknown square, assuming obstructed/bad camera angle")
@@ -148,20 +351,123 @@ class Chessbot:
                         else:
                             # logger.debug(
                             #     "Could not find legal move, trying next result")
+                            unmatched_diffs.append(diffs)
                             update_result = ChessbotFrameUpdateResult.ILLEGAL_MOVE
+                else:
+                    # No single move matches, maybe frames with moves were missed
+                    stage_start = perf_counter()
+                    deadline = stage_start + self._catch_up_time_budget
+                    for diffs in unmatched_diffs:
+                        if self._catch_up_max_plies < 2 or perf_counter() > deadline:
+                            break
+                        moves = self._move_heuristics.try_catch_up(
+                            diffs, max_plies=self._catch_up_max_plies,
+                            deadline=deadline)
+                        if moves is not None:
+                            logger.info(f"Caught up with missed moves {moves}")
+                            update_result = ChessbotFrameUpdateResult.OK
+                            break
+                    self._record_stage("catch_up", stage_start)
+                # Only the last result tried is shown, so only annotate that one
+                if self._annotate_camera_preview:
+                    self._camera_preview = result.annotation
+                write_text(self._camera_preview, f"{result.confidence:.4f}", 10, 10)
+
+        # Restarts the analysis in the background if a move was made
+        if self._engine is not None:
+            stage_start = perf_counter()
+            self._engine.set_position(self._board)
+            self._record_stage("engine", stage_start)
 
         # pgn = self._get_game_pgn_preview()
         # print(pgn)
-        # # info = self._engine.analyse(self._board, chess.engine.Limit(time=0.5))
-        # # score = info['score']
-        # # print(f"{score}")
         # if self._board.outcome() is not None:
         #     print(f"{self._board.outcome()}")
 
-        self._chessboard_preview = self._get_chessboard_preview()
+        if self._render_chessboard_preview:
+            stage_start = perf_counter()
+            self._chessboard_preview = self._get_chessboard_preview()
+            self._record_stage("preview", stage_start)
+
+        # Only frames the board agrees with can be skipped later, others should be
+        # retried
+        if self._motion_gate is not None and update_result in (
+                ChessbotFrameUpdateResult.OK, ChessbotFrameUpdateResult.NO_CHANGE):
+            self._motion_gate.accept()
 
         return update_result
 
+    @property
+    def stage_timings(self) -> dict[str, float]:
+        """
+        Get how long each stage of the last update took. Stages that did not run are
+        left out, and stages that ran several times (like for every candidate
+        arrangement) are summed.
+
+        :return: A dictionary of stage names to seconds.
+        """
+        return self._stage_timings.copy()
+
+    @property
+    def metrics_registry(self) -> Optional[MetricsRegistry]:
+        """
+        Get the registry of the chessbot's metrics.
+
+        :return: A MetricsRegistry, or None if metrics are not recorded.
+        """
+        return self._metrics.registry if self._metrics is not None else None
+
+    @property
+    def board_snapshot(self) -> chess.Board:
+        """
+        Get a copy of the board, safe to use while the chessbot keeps updating.
+
+        :return: A copy of the board, with its move stack.
+        """
+        return self._board.copy()
+
+    @property
+    def engine_suggestion(self) -> Optional[EngineSuggestion]:
+        """
+        Get the best move so far for the current position, from the opening book,
+        tablebases or engine, without waiting for the search.
+
+        :return: An EngineSuggestion with its source, or None if no engine is used or
+         nothing was found yet.
+        """
+        return self._engine.suggestion if self._engine is not None else None
+
+    @property
+    def engine_cache_metrics(self) -> Optional[EngineEvaluationCacheMetrics]:
+        """
+        Get the hit, miss, write and eviction counters of the engine evaluation
+        cache.
+
+        :return: An EngineEvaluationCacheMetrics dataclass, or None if no cache is
+         used.
+        """
+        return self._engine_cache.metrics if self._engine_cache is not None else None
+
+    @property
+    def motion_gate_metrics(self) -> Optional[MotionGateMetrics]:
+        """
+        Get the thresholds and counters of the motion gate.
+
+        :return: A MotionGateMetrics dataclass, or None if no motion gate is used.
+        """
+        return self._motion_gate.metrics if self._motion_gate is not None else None
+
+    @property
+    def piece_cache_metrics(self) -> Optional[PieceClassificationCacheMetrics]:
+        """
+        Get the hit rate and classified square counts of the piece classification
+        cache.
+
+        :return: A PieceClassificationCacheMetrics dataclass, or None if no cache is
+         used.
+        """
+        return self._piece_cache.metrics if self._piece_cache is not None else None
+
     @property
     def camera_preview(self) -> np.ndarray:
         """
@@ -0,0 +1,100 @@
+import logging
+from dataclasses import dataclass
+from typing import Optional
+
+import chess
+import numpy as np
+
+from utils.chess_stuff import get_move_changes
+from utils.logger import create_logger
+
+logger = create_logger(name=__name__, level=logging.DEBUG)
+
+
+@dataclass
+class DecodeMoveResult:
+    move: Optional[chess.Move]
+    log_likelihood: float
+    margin: float
+
+
+class ChessbotMoveDecoder:
+    def __init__(self, board: chess.Board, class_names: dict[int, str]):
+        """
+        Decodes the most likely move from the piece classifier's probabilities,
+        starting from the known position instead of from blind arrangements.
+
+        :param board: The board to decode moves from.
+        :param class_names: The piece classifier's class names, indexed by class.
+         Pieces use their symbol (like "P" or "k") and the other classes are "empty"
+         and "occluded".
+        """
+        self._board = board
+        class_indices = {name: i for i, name in class_names.items()}
+        self._empty_class = class_indices["empty"]
+        self._occluded_class = class_indices.get("occluded")
+        self._piece_classes = {chess.Piece.from_symbol(name): i
+                               for name, i in class_indices.items()
+                               if name not in ("empty", "occluded")}
+        logger.debug("ChessbotMoveDecoder created")
+        logger.setLevel(logging.INFO)
+
+    @property
+    def occluded_class(self) -> Optional[int]:
+        """
+        Get the class index the piece classifier uses for occluded squares.
+
+        :return: The class index, or None if the classifier has no occluded class.
+        """
+        return self._occluded_class
+
+    def _board_classes(self) -> np.ndarray:
+        """
+        Get the class of every square of the board, row by row from the camera's
+        perspective.
+
+        :return: An array of 64 class indices.
+        """
+        classes = np.full(64, self._empty_class, dtype=np.intp)
+        for square, piece in self._board.piece_map().items():
+            # Square a8 is the top left of the camera's perspective
+            classes[square ^ 56] = self._piece_classes[piece]
+        return classes
+
+    def decode(self, probs: np.ndarray) -> DecodeMoveResult:
+        """
+        Score the current position and every position reachable with one legal move
+        against the classifier probabilities and return the most likely move.
+
+        :param probs: A (64, number of classes) probability matrix from the piece
+         classifier, row by row from the camera's perspective.
+        :return: A DecodeMoveResult dataclass. The move is None if the most likely
+         position is the current one. The margin is how much more likely (as a log
+         likelihood ratio) the result is than the runner-up.
+        """
+        effective = probs
+        if self._occluded_class is not None:
+            # An occluded square is evidence for nothing, so it is compatible with
+            # whatever is really on it
+            effective = effective + probs[:, self._occluded_class, np.newaxis]
+        log_probs = np.log(np.maximum(effective, 1e-12))
+
+        moves = [None] + list(self._board.legal_moves)
+        candidates = np.tile(self._board_classes(), (len(moves), 1))
+        rows, squares, classes = [], [], []
+        for i, move in enumerate(moves[1:], start=1):
+            for square, piece in get_move_changes(self._board, move):
+                rows.append(i)
+                squares.append(square ^ 56)
+                classes.append(self._empty_class if piece is None
+                               else self._piece_classes[piece])
+        candidates[rows, squares] = classes
+
+        scores = log_probs[np.arange(64), candidates].sum(axis=1)
+        order = np.argsort(scores)[::-1]
+        best = order[0]
+        margin = float(scores[best] - scores[order[1]]) if len(order) > 1 \
+            else float("inf")
+        logger.debug(f"Decoded move {moves[best]} with margin {margin:.3f}")
+        return DecodeMoveResult(move=moves[best], log_likelihood=float(scores[best]),
+                                margin=margin)
@@ -1,25 +1,38 @@
 import logging
+import os
 from dataclasses import dataclass
 from enum import Enum
-from pathlib import Path
-from typing import Optional
+from math import ceil
+from typing import TYPE_CHECKING, Optional
 
+import cv2
 import numpy as np
-from shapely.geometry.polygon import Polygon
-from ultralytics import YOLO
 
-from utils.cv2_stuff import crop_and_reshape_to_square
+from cv.models import InferenceModelLoader, models_path
+from utils.cv2_stuff import PerspectiveWarper, get_square_perspective_transform, \
+    refine_corners
 from utils.logger import create_logger
 from utils.math_stuff import find_closest_to_right_angles
 
+if TYPE_CHECKING:
+    from shapely.geometry.polygon import Polygon
+
 logger = create_logger(name=__name__, level=logging.DEBUG)
 
-board_segment_ncnn_path = Path.cwd() / "src" / "models" / "board_segmentation_best_ncnn_model"
-logger.info(f"Loading board segmentation model from {board_segment_ncnn_path}")
-board_model = YOLO(board_segment_ncnn_path, task="segment")
+# Set to segment with the model exported at a smaller size by
+# export_board_segmentation.py, like 320, and refine the corners at full resolution
+board_segment_imgsz = int(os.environ["CHESSBOT_BOARD_IMGSZ"]) \
+    if "CHESSBOT_BOARD_IMGSZ" in os.environ else None
+board_segment_stem = "board_segmentation_best" if board_segment_imgsz is None \
+    else f"board_segmentation_best_{board_segment_imgsz}"
+board_segment_ncnn_path = models_path / f"{board_segment_stem}_ncnn_model"
+# Warmed up with a camera frame, see main.py
+board_model_loader = InferenceModelLoader(board_segment_stem, task="segment",
+                                          warm_up_shape=(606, 800, 3))
 
 poly_simp_tolerance = 20
 min_rectangularity = 0.9
+refine_board_corners = board_segment_imgsz is not None
 
 
 class GetChessboardOnlyResultType(Enum):
@@ -34,22 +47,33 @@ class GetChessboardOnlyResult:
     result_type: GetChessboardOnlyResultType
     chessboard: Optional[np.ndarray] = None
     rectangularity: Optional[float] = None
-    polygon: Optional[Polygon] = None
+    polygon: Optional["Polygon"] = None
+    corners: Optional[np.ndarray] = None
+    perspective: Optional[np.ndarray] = None
+    tracked: bool = False
 
 
-def get_chessboard_only(frame: np.ndarray,
-                        chessboard_size: int = 512) -> GetChessboardOnlyResult:
+def get_chessboard_only(frame: np.ndarray, chessboard_size: int = 512,
+                        warper: Optional[PerspectiveWarper] = None,
+                        gray: Optional[np.ndarray] = None) -> \
+        GetChessboardOnlyResult:
     """
     Using a YOLOv11 model, segment the chessboard from the frame and return the
     chessboard only.
 
     :param frame: Camera input.
     :param chessboard_size: Output chessboard size, if detected. Defaults to 512.
+    :param warper: If given, warp the chessboard into its buffer, which is
+     overwritten by its next warp. Its size must be chessboard_size.
+    :param gray: The frame in grayscale, if already converted, to refine the corners
+     with.
     :return: A GetChessboardOnlyResult dataclass.
     """
-    segment_results = board_model(frame, verbose=False)
-    if segment_results[0].masks is not None:
-        mask = segment_results[0].masks.xy[0]
+    from shapely.geometry.polygon import Polygon
+
+    model = board_model_loader.model
+    mask = model.segment(frame)
+    if mask is not None:
 
         pg = Polygon(mask).simplify(tolerance=poly_simp_tolerance)
         rectangularity = pg.area / pg.minimum_rotated_rectangle.area
@@ -58,14 +82,29 @@ def get_chessboard_only(frame: np.ndarray,
         corners = [(int(x), int(y)) for x, y in pg.exterior.coords][:-1]
 
         if rectangularity > min_rectangularity and len(corners) == 4:
-            cb_only = crop_and_reshape_to_square(frame, np.array(
-                [(pt[0], pt[1]) for pt in pg.exterior.coords][:4], dtype="float32"),
-                                                 chessboard_size)
+            corners = np.array([(pt[0], pt[1]) for pt in pg.exterior.coords][:4],
+                               dtype="float32")
+            if refine_board_corners:
+                if gray is None:
+                    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+                # The mask is decoded from prototypes at a quarter of the input
+                # size, so the corners can be off by about that many frame pixels
+                search_radius = ceil(4 * max(frame.shape[:2]) / max(model.imgsz))
+                corners = refine_corners(gray, corners, search_radius)
+                pg = Polygon(corners)
+            perspective = get_square_perspective_transform(corners, chessboard_size)
+            if warper is not None:
+                cb_only = warper.warp(frame, perspective)
+            else:
+                cb_only = cv2.warpPerspective(frame, perspective,
+                                              (chessboard_size, chessboard_size))
             return GetChessboardOnlyResult(
                 result_type=GetChessboardOnlyResultType.CHESSBOARD_FOUND,
                 chessboard=cb_only,
                 rectangularity=rectangularity,
-                polygon=pg
+                polygon=pg,
+                corners=corners,
+                perspective=perspective
             )
         elif rectangularity <= min_rectangularity:
             return GetChessboardOnlyResult(
@@ -77,3 +116,98 @@ def get_chessboard_only(frame: np.ndarray,
                 rectangularity=rectangularity, polygon=pg)
     return GetChessboardOnlyResult(
         result_type=GetChessboardOnlyResultType.NO_CHESSBOARD_FOUND)
+
+
+class ChessboardTracker:
+    def __init__(self, keyframe_interval: int = 30, max_corner_drift: float = 3.0,
+                 chessboard_size: int = 512):
+        """
+        Tracks a chessboard that is fixed under the camera, so the board segmentation
+        model only has to run on keyframes or when the board moves.
+
+        :param keyframe_interval: Maximum number of frames to reuse the last
+         segmentation for. Defaults to 30.
+        :param max_corner_drift: How far in pixels the board corners may move from
+         where they were segmented before segmenting again. Defaults to 3.
+        :param chessboard_size: Output chessboard size. Defaults to 512. The
+         chessboard is warped into a buffer that is overwritten every frame.
+        """
+        self._keyframe_interval = keyframe_interval
+        self._max_corner_drift = max_corner_drift
+        self._chessboard_size = chessboard_size
+        self._warper = PerspectiveWarper(chessboard_size)
+        self._keyframe: Optional[GetChessboardOnlyResult] = None
+        self._keyframe_gray: Optional[np.ndarray] = None
+        self._frames_since_keyframe = 0
+        self._frames = 0
+        self._segmentations = 0
+
+    def reset(self):
+        """
+        Forget the tracked board, so the next frame is segmented.
+        """
+        self._keyframe = None
+        self._keyframe_gray = None
+        self._frames_since_keyframe = 0
+
+    def _board_has_moved(self, gray: np.ndarray) -> bool:
+        """
+        Check if the board corners moved since the keyframe, by following them with
+        Lucas-Kanade optical flow.
+
+        :param gray: The grayscale frame.
+        :return: Whether the corners could not be followed or moved too far.
+        """
+        corners = self._keyframe.corners.reshape(-1, 1, 2)
+        moved_corners, status, _ = cv2.calcOpticalFlowPyrLK(
+            self._keyframe_gray, gray, corners, None, winSize=(21, 21), maxLevel=2)
+        if moved_corners is None or not np.all(status):
+            return True
+        drift = np.linalg.norm(moved_corners - corners, axis=2)
+        return bool(np.max(drift) > self._max_corner_drift)
+
+    def get_chessboard_only(self, frame: np.ndarray) -> GetChessboardOnlyResult:
+        """
+        Like get_chessboard_only, but reuses the last segmentation while the board
+        has not moved.
+
+        :param frame: Camera input.
+        :return: A GetChessboardOnlyResult dataclass. tracked is True if the board was
+         not segmented in this frame.
+        """
+        self._frames += 1
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+        if (self._keyframe is not None and
+                self._frames_since_keyframe < self._keyframe_interval and
+                not self._board_has_moved(gray)):
+            self._frames_since_keyframe += 1
+            return GetChessboardOnlyResult(
+                result_type=GetChessboardOnlyResultType.CHESSBOARD_FOUND,
+                chessboard=self._warper.warp(frame, self._keyframe.perspective),
+                rectangularity=self._keyframe.rectangularity,
+                polygon=self._keyframe.polygon,
+                corners=self._keyframe.corners,
+                perspective=self._keyframe.perspective,
+                tracked=True
+            )
+
+        self._segmentations += 1
+        result = get_chessboard_only(frame, self._chessboard_size, self._warper,
+                                     gray)
+        if result.result_type == GetChessboardOnlyResultType.CHESSBOARD_FOUND:
+            self._keyframe = result
+            self._keyframe_gray = gray
+            self._frames_since_keyframe = 0
+        else:
+            self.reset()
+        return result
+
+    @property
+    def segmentation_rate(self) -> float:
+        """
+        Get the fraction of frames that had to be segmented.
+
+        :return: The fraction of frames segmented, or 0 if there were no frames.
+        """
+        return self._segmentations / self._frames if self._frames > 0 else 0
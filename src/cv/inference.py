@@ -0,0 +1,488 @@
+import importlib.util
+import json
+import logging
+import os
+import platform
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from math import ceil
+from pathlib import Path
+from time import perf_counter
+from typing import Optional
+
+import cv2
+import numpy as np
+import yaml
+
+from utils.logger import create_logger
+
+logger = create_logger(name=__name__, level=logging.DEBUG)
+
+# Ultralytics pads letterboxed images with this gray
+LETTERBOX_COLOR = 114
+
+# Where auto selected backends are remembered, per host
+backend_selection_path = Path.home() / ".cache" / "chessbot" / "inference_backends.json"
+# Models are loaded on several threads at once, but their backends have to be
+# benchmarked one at a time, or they would measure each other
+_backend_selection_lock = threading.Lock()
+
+
+def read_model_metadata(model_dir: Path) -> dict:
+    """
+    Read the metadata.yaml ultralytics exports next to a model.
+
+    :param model_dir: The exported model directory, like
+     models/piece_classification_best_ncnn_model.
+    :return: The metadata, with the names keyed by int.
+    """
+    with open(model_dir / "metadata.yaml") as f:
+        metadata = yaml.safe_load(f)
+    metadata["names"] = {int(i): name for i, name in metadata["names"].items()}
+    return metadata
+
+
+class InferenceBackend(ABC):
+    # Name used to select the backend, and the module it needs
+    name = ""
+    module = ""
+
+    def __init__(self, model_path: Path, num_threads: Optional[int] = None):
+        """
+        Runs an exported model on the CPU.
+
+        :param model_path: Path to the exported model, like from model_path.
+        :param num_threads: Number of threads to run the model with, or None for
+         the backend's default.
+        """
+        self.path = model_path
+        self.num_threads = num_threads
+
+    @classmethod
+    @abstractmethod
+    def model_path(cls, models_dir: Path, stem: str) -> Path:
+        """
+        Get where ultralytics exports a model to in this backend's format.
+
+        :param models_dir: Directory of the models.
+        :param stem: Name of the model, like "piece_classification_best".
+        :return: The path of the exported model, which might not exist.
+        """
+
+    @classmethod
+    def is_available(cls, models_dir: Path, stem: str) -> bool:
+        """
+        Check whether the backend is installed and the model is exported for it.
+
+        :param models_dir: Directory of the models.
+        :param stem: Name of the model, like "piece_classification_best".
+        :return: True if the model can be run with this backend.
+        """
+        return importlib.util.find_spec(cls.module) is not None and \
+            cls.model_path(models_dir, stem).exists()
+
+    @abstractmethod
+    def infer(self, batch: np.ndarray) -> list[np.ndarray]:
+        """
+        Run the model on a batch.
+
+        :param batch: An (N, 3, height, width) float32 array of RGB images scaled to
+         [0, 1].
+        :return: The outputs of the model sorted by name, each with the batch as its
+         first dimension.
+        """
+
+    def warm_up(self, input_shape: tuple[int, ...]):
+        """
+        Run the model once, since the first inference is slower than the rest.
+
+        :param input_shape: Shape of the batches the model will get.
+        """
+        self.infer(np.zeros(input_shape, dtype=np.float32))
+
+
+class NCNNBackend(InferenceBackend):
+    name = "ncnn"
+    module = "ncnn"
+
+    def __init__(self, model_path: Path, num_threads: Optional[int] = None):
+        super().__init__(model_path, num_threads)
+        import ncnn
+
+        self._ncnn = ncnn
+        self.net = ncnn.Net()
+        # Options have to be set before the model is loaded
+        self.net.opt.use_vulkan_compute = False
+        if num_threads is not None:
+            self.net.opt.num_threads = num_threads
+        if self.net.load_param(str(model_path / "model.ncnn.param")) != 0 or \
+                self.net.load_model(str(model_path / "model.ncnn.bin")) != 0:
+            raise RuntimeError(f"Could not load NCNN model from {model_path}")
+        self._in_name = self.net.input_names()[0]
+        self._out_names = sorted(self.net.output_names())
+        # Every image of a batch is copied into this buffer, which the input Mat
+        # wraps without copying
+        self._input: Optional[np.ndarray] = None
+        self._input_mat = None
+
+    @classmethod
+    def model_path(cls, models_dir: Path, stem: str) -> Path:
+        return models_dir / f"{stem}_ncnn_model"
+
+    def infer(self, batch: np.ndarray) -> list[np.ndarray]:
+        if self._input is None or self._input.shape != batch.shape[1:]:
+            self._input = np.zeros(batch.shape[1:], dtype=np.float32)
+            self._input_mat = self._ncnn.Mat(self._input)
+        outputs = [[] for _ in self._out_names]
+        # NCNN has no batch dimension, so the images are run one at a time
+        for image in batch:
+            np.copyto(self._input, image)
+            # Extractors keep the blobs they computed, so every image needs its own
+            with self.net.create_extractor() as ex:
+                ex.input(self._in_name, self._input_mat)
+                for i, out_name in enumerate(self._out_names):
+                    _, out = ex.extract(out_name)
+                    outputs[i].append(np.array(out))
+        return [np.stack(output) for output in outputs]
+
+
+class ONNXRuntimeBackend(InferenceBackend):
+    name = "onnxruntime"
+    module = "onnxruntime"
+
+    def __init__(self, model_path: Path, num_threads: Optional[int] = None):
+        super().__init__(model_path, num_threads)
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = \
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self._session = onnxruntime.InferenceSession(
+            str(model_path), options, providers=["CPUExecutionProvider"])
+        model_input = self._session.get_inputs()[0]
+        self._in_name = model_input.name
+        # Models exported with dynamic=True take whole batches
+        self._batched = model_input.shape[0] != 1
+        self._out_names = sorted(output.name for output in self._session.get_outputs())
+
+    @classmethod
+    def model_path(cls, models_dir: Path, stem: str) -> Path:
+        return models_dir / f"{stem}.onnx"
+
+    def infer(self, batch: np.ndarray) -> list[np.ndarray]:
+        if self._batched:
+            return self._session.run(self._out_names, {self._in_name: batch})
+        outputs = [self._session.run(self._out_names, {self._in_name: image[np.newaxis]})
+                   for image in batch]
+        return [np.concatenate(output) for output in zip(*outputs)]
+
+
+class OpenVINOBackend(InferenceBackend):
+    name = "openvino"
+    module = "openvino"
+
+    def __init__(self, model_path: Path, num_threads: Optional[int] = None):
+        super().__init__(model_path, num_threads)
+        import openvino
+
+        core = openvino.Core()
+        model = core.read_model(next(model_path.glob("*.xml")))
+        # Models exported with dynamic=True take whole batches
+        self._batched = model.inputs[0].partial_shape[0].is_dynamic
+        config = {"INFERENCE_NUM_THREADS": num_threads} \
+            if num_threads is not None else {}
+        compiled = core.compile_model(model, "CPU", config)
+        self._request = compiled.create_infer_request()
+        self._outputs = sorted(compiled.outputs, key=lambda o: o.get_any_name())
+
+    @classmethod
+    def model_path(cls, models_dir: Path, stem: str) -> Path:
+        return models_dir / f"{stem}_openvino_model"
+
+    def infer(self, batch: np.ndarray) -> list[np.ndarray]:
+        if self._batched:
+            result = self._request.infer({0: batch})
+            return [result[output].copy() for output in self._outputs]
+        outputs = []
+        for image in batch:
+            result = self._request.infer({0: image[np.newaxis]})
+            outputs.append([result[output].copy() for output in self._outputs])
+        return [np.concatenate(output) for output in zip(*outputs)]
+
+
+BACKENDS: dict[str, type[InferenceBackend]] = {
+    backend.name: backend
+    for backend in (NCNNBackend, ONNXRuntimeBackend, OpenVINOBackend)
+}
+
+
+def benchmark_backend(backend: InferenceBackend, input_shape: tuple[int, ...],
+                      runs: int = 10) -> float:
+    """
+    Measure how fast a backend runs a model.
+
+    :param backend: The backend, with the model loaded.
+    :param input_shape: Shape of the batches the model will get.
+    :param runs: Number of timed runs, after one to warm up.
+    :return: The median latency in seconds.
+    """
+    batch = np.random.default_rng(0).random(input_shape, dtype=np.float32)
+    backend.infer(batch)
+    timings = []
+    for _ in range(runs):
+        start = perf_counter()
+        backend.infer(batch)
+        timings.append(perf_counter() - start)
+    return float(np.median(timings))
+
+
+def _read_backend_selections() -> dict:
+    """
+    Read the backends selected earlier.
+
+    :return: The selections by host, or an empty dictionary if there are none or
+     they could not be read.
+    """
+    try:
+        with open(backend_selection_path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, json.JSONDecodeError) as e:
+        logger.warning(f"Could not read {backend_selection_path}, ignoring it: {e}")
+        return {}
+
+
+def _write_backend_selections(selections: dict):
+    """
+    Save the selected backends, replacing the file in one step so it is never left
+    half written.
+
+    :param selections: The selections by host.
+    """
+    backend_selection_path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile("w", dir=backend_selection_path.parent,
+                                     suffix=".tmp", delete=False) as f:
+        json.dump(selections, f, indent=2)
+    os.replace(f.name, backend_selection_path)
+
+
+def select_backend(models_dir: Path, stem: str, input_shape: tuple[int, ...],
+                   num_threads: Optional[int] = None) -> InferenceBackend:
+    """
+    Load a model with the fastest available backend on this host. Every backend is
+    benchmarked the first time, and the winner is remembered in
+    backend_selection_path until the available backends change. Only one model is
+    selected at a time.
+
+    :param models_dir: Directory of the models.
+    :param stem: Name of the model, like "piece_classification_best".
+    :param input_shape: Shape of the batches the model will get, to benchmark with.
+    :param num_threads: Number of threads to run the model with, or None for each
+     backend's default.
+    :return: The fastest backend, with the model loaded.
+    """
+    available = sorted(name for name, backend in BACKENDS.items()
+                       if backend.is_available(models_dir, stem))
+    if len(available) == 0:
+        raise RuntimeError(f"No inference backend can run {stem}")
+    if len(available) == 1:
+        return BACKENDS[available[0]](
+            BACKENDS[available[0]].model_path(models_dir, stem), num_threads)
+    host = f"{platform.node()} {platform.machine()}"
+    key = f"{stem} {num_threads or 'default'} threads"
+
+    with _backend_selection_lock:
+        selection = _read_backend_selections().get(host, {}).get(key)
+        if selection is not None and selection["available"] == available:
+            logger.info(f"Using {selection['backend']} for {stem}, selected earlier")
+            return BACKENDS[selection["backend"]](
+                BACKENDS[selection["backend"]].model_path(models_dir, stem),
+                num_threads)
+
+        logger.info(f"Benchmarking {', '.join(available)} for {stem}")
+        latencies = {}
+        fastest = None
+        for name in available:
+            backend = BACKENDS[name](BACKENDS[name].model_path(models_dir, stem),
+                                     num_threads)
+            latencies[name] = benchmark_backend(backend, input_shape)
+            logger.info(f"{name} runs {stem} in {latencies[name] * 1000:.1f} ms")
+            if fastest is None or latencies[name] < latencies[fastest.name]:
+                fastest = backend
+        logger.info(f"Selected {fastest.name} for {stem}")
+
+        # Read again, in case another process saved its selections meanwhile
+        selections = _read_backend_selections()
+        selections.setdefault(host, {})[key] = {
+            "backend": fastest.name,
+            "available": available,
+            "latency_ms": {name: latency * 1000
+                           for name, latency in latencies.items()}
+        }
+        _write_backend_selections(selections)
+    return fastest
+
+
+def load_backend(models_dir: Path, stem: str, name: str,
+                 input_shape: tuple[int, ...],
+                 num_threads: Optional[int] = None) -> InferenceBackend:
+    """
+    Load a model with a backend.
+
+    :param models_dir: Directory of the models.
+    :param stem: Name of the model, like "piece_classification_best".
+    :param name: Name of the backend, like "ncnn", or "auto" for the fastest one.
+    :param input_shape: Shape of the batches the model will get, used when
+     selecting the fastest backend.
+    :param num_threads: Number of threads to run the model with, or None for the
+     backend's default.
+    :return: The backend, with the model loaded.
+    """
+    if name == "auto":
+        return select_backend(models_dir, stem, input_shape, num_threads)
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown inference backend {name}, use one of "
+                         f"{', '.join(BACKENDS)} or auto")
+    return BACKENDS[name](BACKENDS[name].model_path(models_dir, stem), num_threads)
+
+
+class Classifier:
+    def __init__(self, backend: InferenceBackend, metadata: dict):
+        """
+        A classification model, like the piece model.
+
+        :param backend: The backend running the model.
+        :param metadata: The model's metadata, like from read_model_metadata.
+        """
+        self.backend = backend
+        self.names: dict[int, str] = metadata["names"]
+        self.imgsz: tuple[int, int] = tuple(metadata["imgsz"])
+
+    def classify(self, batch: np.ndarray) -> np.ndarray:
+        """
+        Classify a batch of images.
+
+        :param batch: An (N, 3, height, width) float32 array of RGB images scaled to
+         [0, 1], like from cv.pieces.get_square_batch.
+        :return: An (N, number of classes) probability matrix. The exported model
+         already ends in a softmax.
+        """
+        return self.backend.infer(batch)[0].reshape(len(batch), len(self.names))
+
+    def warm_up(self):
+        """
+        Run the model once, since the first inference is slower than the rest.
+        """
+        self.backend.warm_up((64, 3, *self.imgsz))
+
+
+class Segmenter:
+    def __init__(self, backend: InferenceBackend, metadata: dict,
+                 conf: float = 0.25):
+        """
+        A YOLO segmentation model, like the board model. Only the most confident
+        detection is decoded, since there is only one board.
+
+        :param backend: The backend running the model.
+        :param metadata: The model's metadata, like from read_model_metadata.
+        :param conf: Minimum confidence of a detection. Defaults to 0.25, like
+         ultralytics.
+        """
+        self.backend = backend
+        self.names: dict[int, str] = metadata["names"]
+        self.imgsz: tuple[int, int] = tuple(metadata["imgsz"])
+        self._conf = conf
+        height, width = self.imgsz
+        self._padded = np.full((height, width, 3), LETTERBOX_COLOR, dtype=np.uint8)
+        self._input = np.zeros((1, 3, height, width), dtype=np.float32)
+        # Letterbox geometry of the last frame shape, as (shape, scale, left, top,
+        # resized width, resized height)
+        self._letterbox: Optional[tuple] = None
+
+    def _letterbox_frame(self, frame: np.ndarray) -> tuple[float, int, int]:
+        """
+        Resize the frame into the padded buffer, keeping its aspect ratio like
+        ultralytics' letterbox, and turn it into the model input.
+
+        :param frame: BGR frame.
+        :return: A tuple of the scale and the left and top padding.
+        """
+        if self._letterbox is None or self._letterbox[0] != frame.shape:
+            height, width = self.imgsz
+            scale = min(height / frame.shape[0], width / frame.shape[1])
+            resized_width = round(frame.shape[1] * scale)
+            resized_height = round(frame.shape[0] * scale)
+            left = round((width - resized_width) / 2 - 0.1)
+            top = round((height - resized_height) / 2 - 0.1)
+            self._padded[:] = LETTERBOX_COLOR
+            self._letterbox = (frame.shape, scale, left, top, resized_width,
+                               resized_height)
+        _, scale, left, top, resized_width, resized_height = self._letterbox
+        cv2.resize(frame, (resized_width, resized_height),
+                   dst=self._padded[top:top + resized_height,
+                                    left:left + resized_width],
+                   interpolation=cv2.INTER_LINEAR)
+        # (y, x, BGR) -> (RGB, y, x) as a view, which is scaled straight into the
+        # input
+        np.multiply(self._padded[..., ::-1].transpose(2, 0, 1), np.float32(1 / 255),
+                    out=self._input[0])
+        return scale, left, top
+
+    def segment(self, frame: np.ndarray) -> Optional[np.ndarray]:
+        """
+        Segment the most confident object in a frame.
+
+        :param frame: BGR frame, like from the camera.
+        :return: An (N, 2) float32 array of the outline of the object in frame
+         pixels, like ultralytics' masks.xy[0], or None if nothing was found.
+        """
+        scale, left, top = self._letterbox_frame(frame)
+        height, width = self.imgsz
+        # (4 box values + classes + mask coefficients, anchors) and (mask
+        # coefficients, proto height, proto width)
+        detections, protos = (output[0] for output in self.backend.infer(self._input))
+        scores = detections[4:4 + len(self.names)].max(axis=0)
+        best = int(scores.argmax())
+        if scores[best] < self._conf:
+            return None
+
+        coefficients = detections[4 + len(self.names):, best]
+        proto_height, proto_width = protos.shape[1:]
+        mask = 1 / (1 + np.exp(-(coefficients @ protos.reshape(len(coefficients), -1))))
+        mask = mask.reshape(proto_height, proto_width).astype(np.float32)
+
+        # Only keep the mask inside the box, like ultralytics' crop_mask
+        cx, cy, w, h = detections[:4, best]
+        x_scale, y_scale = proto_width / width, proto_height / height
+        x0, x1 = ceil((cx - w / 2) * x_scale), ceil((cx + w / 2) * x_scale)
+        y0, y1 = ceil((cy - h / 2) * y_scale), ceil((cy + h / 2) * y_scale)
+        cropped = np.zeros_like(mask)
+        cropped[max(y0, 0):y1, max(x0, 0):x1] = mask[max(y0, 0):y1, max(x0, 0):x1]
+
+        binary = (cv2.resize(cropped, (width, height),
+                             interpolation=cv2.INTER_LINEAR) > 0.5).astype(np.uint8)
+        contours, _ = cv2.findContours(binary, cv2.RETR_EXTERNAL,
+                                       cv2.CHAIN_APPROX_SIMPLE)
+        if len(contours) == 0:
+            return None
+        outline = max(contours, key=cv2.contourArea).reshape(-1, 2).astype(np.float32)
+        # From the letterboxed input back to the frame
+        outline -= (left, top)
+        outline /= scale
+        np.clip(outline[:, 0], 0, frame.shape[1], out=outline[:, 0])
+        np.clip(outline[:, 1], 0, frame.shape[0], out=outline[:, 1])
+        return outline
+
+    def warm_up(self, frame_shape: tuple[int, int, int]):
+        """
+        Run the model once, since the first inference is slower than the rest.
+
+        :param frame_shape: Shape of the frames that will be segmented, so the
+         letterbox is set up for them too.
+        """
+        self._letterbox_frame(np.zeros(frame_shape, dtype=np.uint8))
+        self.backend.infer(self._input)
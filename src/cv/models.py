@@ -0,0 +1,193 @@
+import logging
+import os
+import threading
+from abc import ABC, abstractmethod
+from pathlib import Path
+from time import perf_counter
+from typing import TYPE_CHECKING, Any, Optional
+
+import numpy as np
+
+from cv.inference import Classifier, NCNNBackend, ONNXRuntimeBackend, Segmenter, \
+    load_backend, read_model_metadata
+from utils.logger import create_logger
+
+# Ultralytics imports torch, so it is only imported when a model is loaded
+if TYPE_CHECKING:
+    from ultralytics import YOLO
+
+logger = create_logger(name=__name__, level=logging.DEBUG)
+
+models_path = Path.cwd() / "src" / "models"
+
+# Threads every model runs with, or the backend's default if not set
+inference_threads = int(os.environ["CHESSBOT_INFERENCE_THREADS"]) \
+    if "CHESSBOT_INFERENCE_THREADS" in os.environ else None
+
+# Backend every model runs with, one of BACKENDS or "auto" for the fastest one on
+# this host
+inference_backend = os.environ.get("CHESSBOT_INFERENCE_BACKEND", NCNNBackend.name)
+
+
+class ModelLoader(ABC):
+    def __init__(self, path: Path, task: str):
+        """
+        Loads a model the first time it is needed, and warms it up so the first real
+        inference is not slower than the rest. Safe to use from several threads,
+        which all wait for the same load.
+
+        :param path: Path to the exported model, like an NCNN model directory.
+        :param task: The task of the model, like "segment" or "classify".
+        """
+        self.path = path
+        self.task = task
+        self._lock = threading.Lock()
+        self._model: Optional[Any] = None
+        self._names: Optional[dict[int, str]] = None
+        self.load_seconds: Optional[float] = None
+
+    @property
+    def names(self) -> dict[int, str]:
+        """
+        Get the class names of the model, without loading it.
+
+        :return: A dictionary of class indices to names.
+        """
+        if self._names is None:
+            self._names = read_model_metadata(self.path)["names"]
+        return self._names
+
+    @property
+    def loaded(self) -> bool:
+        """
+        Get whether the model is loaded and warmed up.
+
+        :return: True if the model is ready.
+        """
+        return self._model is not None
+
+    @abstractmethod
+    def _load_model(self) -> Any:
+        """
+        Load and warm up the model.
+
+        :return: The model.
+        """
+
+    def load(self) -> Any:
+        """
+        Load and warm up the model, or wait until another thread has.
+
+        :return: The model.
+        """
+        if self._model is not None:
+            return self._model
+        with self._lock:
+            if self._model is None:
+                start = perf_counter()
+                logger.info(f"Loading {self.task} model from {self.path}")
+                model = self._load_model()
+                self.load_seconds = perf_counter() - start
+                logger.info(f"Loaded {self.task} model in {self.load_seconds:.2f} s")
+                self._model = model
+        return self._model
+
+    def load_async(self) -> threading.Thread:
+        """
+        Start loading the model on a background thread.
+
+        :return: The thread, which ends once the model is loaded.
+        """
+        thread = threading.Thread(target=self.load, name=f"{self.task} model loader",
+                                  daemon=True)
+        thread.start()
+        return thread
+
+    @property
+    def model(self) -> Any:
+        """
+        Get the model, loading it first if needed.
+
+        :return: The model.
+        """
+        return self.load()
+
+
+class InferenceModelLoader(ModelLoader):
+    def __init__(self, stem: str, task: str,
+                 warm_up_shape: Optional[tuple[int, int, int]] = None,
+                 backend: Optional[str] = None, precision: str = "fp32"):
+        """
+        Loads a model exported by ultralytics to run directly with one of the
+        inference backends, as a Segmenter or Classifier depending on the task.
+
+        :param stem: Name of the model in models_path, like
+         "piece_classification_best".
+        :param task: "segment" or "classify".
+        :param warm_up_shape: Shape of the frames a segmentation model will get,
+         like the camera frame size.
+        :param backend: One of BACKENDS, or "auto" for the fastest one on this host.
+         Defaults to inference_backend.
+        :param precision: "fp32", or "int8" for the model quantized by
+         train/quantize_piece_classification.py, which only ONNX Runtime runs.
+         Defaults to "fp32".
+        """
+        # The metadata is read from the NCNN export, which every backend shares
+        super().__init__(NCNNBackend.model_path(models_path, stem), task)
+        if precision not in ("fp32", "int8"):
+            raise ValueError(f"Unknown precision {precision}, use fp32 or int8")
+        self.precision = precision
+        self.stem = stem if precision == "fp32" else f"{stem}_{precision}"
+        self.backend = backend or inference_backend
+        if precision == "int8" and self.backend != "auto":
+            self.backend = ONNXRuntimeBackend.name
+        self._warm_up_shape = warm_up_shape
+
+    def _load_model(self) -> Segmenter | Classifier:
+        metadata = read_model_metadata(self.path)
+        height, width = metadata["imgsz"]
+        input_shape = (1, 3, height, width) if self.task == "segment" \
+            else (64, 3, height, width)
+        backend = load_backend(models_path, self.stem, self.backend, input_shape,
+                               num_threads=inference_threads)
+        logger.debug(f"Running {self.precision} {self.task} model with {backend.name}")
+        if self.task == "segment":
+            model = Segmenter(backend, metadata)
+            model.warm_up(self._warm_up_shape)
+        else:
+            model = Classifier(backend, metadata)
+            model.warm_up()
+        return model
+
+
+class YOLOModelLoader(ModelLoader):
+    def __init__(self, path: Path, task: str, warm_up_shape: tuple[int, int, int],
+                 imgsz: Optional[int] = None):
+        """
+        Loads a model with ultralytics, which is slower than running it directly
+        but supports every format. Used to compare against.
+
+        :param path: Path to the exported model, like an NCNN model directory.
+        :param task: The task of the model, like "segment" or "classify".
+        :param warm_up_shape: Shape of the dummy input, which should be the shape of
+         the real inputs, like the camera frame size.
+        :param imgsz: Image size to run the model at, if not its default.
+        """
+        super().__init__(path, task)
+        self._warm_up_shape = warm_up_shape
+        self._imgsz = imgsz
+
+    def _load_model(self) -> "YOLO":
+        from ultralytics import YOLO
+
+        model = YOLO(self.path, task=self.task)
+        # The predictor (and the backend it wraps) is only created on the first
+        # call, and the first call has been seen to raise a TypeError while setting
+        # up NCNN, so that one is allowed to fail
+        dummy = np.zeros(self._warm_up_shape, dtype=np.uint8)
+        try:
+            model(dummy, imgsz=self._imgsz, verbose=False)
+        except TypeError:
+            logger.debug("First warm up inference failed, trying again")
+            model(dummy, imgsz=self._imgsz, verbose=False)
+        return model
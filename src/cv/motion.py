@@ -0,0 +1,129 @@
+import logging
+from dataclasses import dataclass
+from enum import Enum
+from typing import Optional
+
+import cv2
+import numpy as np
+
+from utils.logger import create_logger
+
+logger = create_logger(name=__name__, level=logging.DEBUG)
+
+
+class MotionGateResultType(Enum):
+    CHANGED = "CHANGED"
+    UNCHANGED = "UNCHANGED"
+    MOTION = "MOTION"
+
+
+@dataclass
+class MotionGateMetrics:
+    motion_threshold: float
+    change_threshold: float
+    frames: int = 0
+    processed: int = 0
+    skipped_unchanged: int = 0
+    skipped_motion: int = 0
+    last_motion: float = 0
+    last_change: float = 0
+
+    @property
+    def skipped_fraction(self) -> float:
+        """
+        Get the fraction of frames that were skipped.
+
+        :return: The fraction of frames skipped, or 0 if there were no frames.
+        """
+        if self.frames == 0:
+            return 0
+        return (self.skipped_unchanged + self.skipped_motion) / self.frames
+
+
+class MotionGate:
+    def __init__(self, motion_threshold: float = 0.01, change_threshold: float = 0.002,
+                 settle_frames: int = 3, pixel_threshold: int = 25,
+                 size: tuple[int, int] = (80, 60)):
+        """
+        Decides which frames are worth running the full pipeline on, by comparing
+        small grayscale versions of them.
+
+        :param motion_threshold: Fraction of pixels that must change between two
+         consecutive frames to count as motion. Defaults to 0.01.
+        :param change_threshold: Fraction of pixels that must differ from the last
+         processed frame for a settled frame to count as changed. Defaults to 0.002.
+        :param settle_frames: Number of consecutive frames without motion before the
+         scene counts as settled. Defaults to 3.
+        :param pixel_threshold: How much a pixel's brightness must change to count as
+         changed. Defaults to 25.
+        :param size: Size (width, height) frames are downscaled to. Defaults to
+         (80, 60).
+        """
+        self._settle_frames = settle_frames
+        self._pixel_threshold = pixel_threshold
+        self._size = size
+        self._previous: Optional[np.ndarray] = None
+        self._current: Optional[np.ndarray] = None
+        self._stable: Optional[np.ndarray] = None
+        self._still_frames = 0
+        self._metrics = MotionGateMetrics(motion_threshold=motion_threshold,
+                                          change_threshold=change_threshold)
+
+    def _changed_fraction(self, a: np.ndarray, b: np.ndarray) -> float:
+        return float(np.count_nonzero(cv2.absdiff(a, b) > self._pixel_threshold) /
+                     a.size)
+
+    def check(self, frame: np.ndarray) -> MotionGateResultType:
+        """
+        Check a new frame.
+
+        :param frame: The frame, typically from a camera.
+        :return: MOTION if the scene is moving or still settling, UNCHANGED if it is
+         settled and looks like the last processed frame, otherwise CHANGED.
+        """
+        small = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), self._size,
+                           interpolation=cv2.INTER_AREA)
+        small = cv2.GaussianBlur(small, (3, 3), 0)
+        self._previous, self._current = self._current, small
+        self._metrics.frames += 1
+
+        if self._previous is not None:
+            self._metrics.last_motion = self._changed_fraction(self._previous, small)
+            if self._metrics.last_motion > self._metrics.motion_threshold:
+                self._still_frames = 0
+            else:
+                self._still_frames += 1
+            if self._still_frames < self._settle_frames:
+                self._metrics.skipped_motion += 1
+                return MotionGateResultType.MOTION
+
+        if self._stable is not None:
+            self._metrics.last_change = self._changed_fraction(self._stable, small)
+            if self._metrics.last_change <= self._metrics.change_threshold:
+                self._metrics.skipped_unchanged += 1
+                return MotionGateResultType.UNCHANGED
+
+        self._metrics.processed += 1
+        return MotionGateResultType.CHANGED
+
+    def accept(self):
+        """
+        Remember the last checked frame as the last processed one, so later frames
+        that look like it are UNCHANGED. Call this once the pipeline handled it.
+        """
+        self._stable = self._current
+
+    def reset(self):
+        """
+        Forget the last processed frame, so the next settled frame is CHANGED.
+        """
+        self._stable = None
+
+    @property
+    def metrics(self) -> MotionGateMetrics:
+        """
+        Get the thresholds and counters of the motion gate.
+
+        :return: A MotionGateMetrics dataclass.
+        """
+        return self._metrics
@@ -1,20 +1,26 @@
 import logging
-from dataclasses import dataclass
-from itertools import product
-from pathlib import Path
-from typing import Optional
+import os
+from dataclasses import dataclass, field
+from functools import lru_cache
+from heapq import heappop, heappush
+from typing import Optional, Sequence
 
 import cv2
 import numpy as np
-from ultralytics import YOLO
 
+from cv.models import InferenceModelLoader, models_path
+from utils.chess_stuff import arrangement_to_string, symbol_to_code
+from utils.cv2_stuff import get_tile_view
 from utils.logger import create_logger
 
 logger = create_logger(name=__name__, level=logging.DEBUG)
 
-piece_classify_ncnn_path = Path.cwd() / "src" / "models" / "piece_classification_best_ncnn_model"
-logger.info(f"Loading piece classification model from {piece_classify_ncnn_path}")
-piece_model = YOLO(piece_classify_ncnn_path, task="classify")
+piece_classify_stem = "piece_classification_best"
+piece_classify_ncnn_path = models_path / f"{piece_classify_stem}_ncnn_model"
+# "fp32", or "int8" for the model quantized by train/quantize_piece_classification.py
+piece_precision = os.environ.get("CHESSBOT_PIECE_PRECISION", "fp32")
+piece_model_loader = InferenceModelLoader(piece_classify_stem, task="classify",
+                                          precision=piece_precision)
 
 colors = {
     "b": (255, 255, 0),  # yellow
@@ -34,106 +40,357 @@ colors = {
 }
 
 
+# Piece code of every class of the piece model, see utils.chess_stuff
+class_codes = np.array([symbol_to_code({"empty": ".", "occluded": "?"}.get(name, name))
+                        for _, name in sorted(piece_model_loader.names.items())],
+                       dtype=np.int8)
+# Tile i (row by row from the camera's perspective) is square i ^ 56, and back
+tile_of_square = np.arange(64) ^ 56
+
+
+# Annotation color of every class of the piece model, as BGR
+class_colors = np.array([colors[name][::-1]
+                         for _, name in sorted(piece_model_loader.names.items())],
+                        dtype=np.uint8)
+
+
+@lru_cache
+def get_annotation_rings(chessboard_size: int) -> np.ndarray:
+    """
+    Get the mask of the rings drawn around the tiles of an annotation.
+
+    :param chessboard_size: Size of the chessboard only image.
+    :return: A (chessboard_size, chessboard_size) uint8 mask.
+    """
+    tile_size = chessboard_size // 8
+    ring = np.zeros((tile_size, tile_size), dtype=np.uint8)
+    cv2.rectangle(ring, (4, 4), (tile_size - 4, tile_size - 4), 1, 4)
+    return np.tile(ring, (8, 8))
+
+
+def draw_piece_annotation(cb_only: np.ndarray, classes: np.ndarray) -> np.ndarray:
+    """
+    Draw a ring in the color of its class around every tile.
+
+    :param cb_only: Chessboard only image.
+    :param classes: The class of every tile, row by row from the camera's
+     perspective.
+    :return: An annotated copy of the image.
+    """
+    size = cb_only.shape[0]
+    tile_size = size // 8
+    # Every pixel in the color of its tile, filled a row of tiles at a time
+    tile_colors = class_colors[classes].reshape(8, 8, 3)
+    overlay = np.empty_like(cb_only)
+    overlay.reshape(8, tile_size, size, 3)[:] = \
+        np.repeat(tile_colors, tile_size, axis=1)[:, np.newaxis]
+    annotation = cb_only.copy()
+    cv2.copyTo(overlay, get_annotation_rings(size), annotation)
+    return annotation
+
+
 @dataclass
 class GetPieceMatrixResult:
-    pieces: str
+    pieces: np.ndarray
     confidence: float
-    annotation: Optional[np.ndarray] = None
+    # The class of every tile, row by row from the camera's perspective
+    classes: Optional[np.ndarray] = None
+    # Only kept to draw the annotation when it is asked for
+    chessboard: Optional[np.ndarray] = field(default=None, repr=False)
+    _annotation: Optional[np.ndarray] = field(default=None, init=False, repr=False)
+
+    @property
+    def annotation(self) -> Optional[np.ndarray]:
+        """
+        Get the chessboard image annotated with the class of every tile. It is only
+        drawn the first time it is asked for, so ask before the chessboard image is
+        reused for the next frame.
+
+        :return: The annotated image, or None if annotations were not requested.
+        """
+        if self._annotation is None and self.chessboard is not None:
+            self._annotation = draw_piece_annotation(self.chessboard, self.classes)
+        return self._annotation
+
+    def __str__(self) -> str:
+        return f"{arrangement_to_string(self.pieces)}\n({self.confidence:.4f})"
+
+
+def get_square_batch(cb_only: np.ndarray, square_size: int = 64,
+                     squares: Optional[Sequence[int]] = None) -> np.ndarray:
+    """
+    Turn the chessboard only image into a batch of squares for the piece model.
+
+    :param cb_only: Chessboard only image. (BGR, like from OpenCV)
+    :param square_size: Size of each square fed to the model. Defaults to 64.
+    :param squares: Indices of the squares to put in the batch, row by row from the
+     camera's perspective. Defaults to all 64.
+    :return: A (number of squares, 3, square_size, square_size) float32 array of RGB
+     squares scaled to [0, 1], in the order of `squares`.
+    """
+    board_size = square_size * 8
+    if cb_only.shape[0] != board_size or cb_only.shape[1] != board_size:
+        cb_only = cv2.resize(cb_only, (board_size, board_size),
+                             interpolation=cv2.INTER_AREA)
+    tiles = get_tile_view(cb_only)
+    if squares is None:
+        squares = np.arange(64)
+    rows, cols = np.divmod(np.asarray(squares, dtype=np.intp), 8)
+    # Only the requested tiles are copied out of the view, as (square, y, x, BGR)
+    tiles = tiles[rows, cols]
+    # (square, y, x, BGR) -> (square, RGB, y, x) as a view, which is scaled
+    # straight into the batch
+    batch = np.empty((len(squares), 3, square_size, square_size), dtype=np.float32)
+    np.multiply(tiles[..., ::-1].transpose(0, 3, 1, 2), np.float32(1 / 255),
+                out=batch)
+    return batch
+
+
+def classify_squares(cb_only: np.ndarray,
+                     squares: Optional[Sequence[int]] = None) -> np.ndarray:
+    """
+    Classify the squares of the chessboard only image in one batch.
+
+    :param cb_only: Chessboard only image.
+    :param squares: Indices of the squares to classify, row by row from the camera's
+     perspective. Defaults to all 64.
+    :return: A (number of squares, number of classes) probability matrix, in the
+     order of `squares`. Columns are indexed like `piece_model_loader.names`.
+    """
+    batch = get_square_batch(cb_only, squares=squares)
+    return piece_model_loader.model.classify(batch)
+
+
+@dataclass
+class PieceClassificationCacheMetrics:
+    frames: int = 0
+    hits: int = 0
+    misses: int = 0
+    last_classified: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        """
+        Get the fraction of squares that were served from the cache.
+
+        :return: The hit rate, or 0 if nothing was classified yet.
+        """
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0
+
+
+class PieceClassificationCache:
+    def __init__(self, threshold: float = 8.0, max_corner_drift: float = 3.0):
+        """
+        Caches the piece classifier's probabilities for every square, so only the
+        squares whose pixels changed have to be classified again.
+
+        :param threshold: Mean absolute pixel difference a square must have from when
+         it was last classified to be classified again. Defaults to 8.
+        :param max_corner_drift: How far in pixels the board corners may move from
+         where they were when the cache was filled before it is invalidated.
+         Defaults to 3, like ChessboardTracker, so segmenting the same board again
+         on a keyframe keeps the cache.
+        """
+        self._threshold = threshold
+        self._max_corner_drift = max_corner_drift
+        self._reference: Optional[np.ndarray] = None
+        self._probs: Optional[np.ndarray] = None
+        self._perspective: Optional[np.ndarray] = None
+        self._metrics = PieceClassificationCacheMetrics()
+
+    def invalidate(self):
+        """
+        Forget all cached squares, so the next frame classifies all of them.
+        """
+        self._reference = None
+        self._probs = None
+        self._perspective = None
+
+    @staticmethod
+    def _get_corners(perspective: np.ndarray, size: int) -> np.ndarray:
+        """
+        Get where the corners of the chessboard only image are in the frame.
+
+        :param perspective: The perspective matrix the image was warped with.
+        :param size: Size of the chessboard only image.
+        :return: A (4, 2) array of the corners in frame pixels.
+        """
+        square = np.array([[[0, 0], [size - 1, 0], [size - 1, size - 1],
+                            [0, size - 1]]], dtype=np.float64)
+        return cv2.perspectiveTransform(square, np.linalg.inv(perspective))[0]
+
+    def _board_moved(self, cb_only: np.ndarray,
+                     perspective: Optional[np.ndarray]) -> bool:
+        """
+        Check if the chessboard only image can't be compared with the cached one,
+        because the board was warped from a different place in the frame.
+
+        :param cb_only: Chessboard only image.
+        :param perspective: The perspective matrix cb_only was warped with.
+        :return: Whether the cache has to be invalidated.
+        """
+        if self._reference.shape != cb_only.shape or \
+                (perspective is None) != (self._perspective is None):
+            return True
+        if perspective is None or np.array_equal(perspective, self._perspective):
+            return False
+        size = cb_only.shape[0]
+        drift = np.linalg.norm(self._get_corners(perspective, size) -
+                               self._get_corners(self._perspective, size), axis=1)
+        return bool(np.max(drift) > self._max_corner_drift)
+
+    def classify_squares(self, cb_only: np.ndarray,
+                         perspective: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Like classify_squares, but only classifies squares that changed since they
+        were last classified.
+
+        :param cb_only: Chessboard only image.
+        :param perspective: The perspective matrix cb_only was warped with. The cache
+         is invalidated when it moves the board corners by more than
+         max_corner_drift pixels.
+        :return: A (64, number of classes) probability matrix, row by row from the
+         camera's perspective.
+        """
+        if self._reference is not None and self._board_moved(cb_only, perspective):
+            logger.debug("Board moved, invalidating piece classification cache")
+            self.invalidate()
+
+        if self._reference is None:
+            changed = np.arange(64)
+            self._reference = cb_only.copy()
+            self._probs = classify_squares(cb_only)
+            self._perspective = perspective
+        else:
+            diff = get_tile_view(cv2.absdiff(cb_only, self._reference))
+            square_diffs = diff.mean(axis=(2, 3, 4)).reshape(64)
+            changed = np.flatnonzero(square_diffs > self._threshold)
+            if len(changed) > 0:
+                self._probs[changed] = classify_squares(cb_only, changed)
+                rows, cols = np.divmod(changed, 8)
+                get_tile_view(self._reference)[rows, cols] = \
+                    get_tile_view(cb_only)[rows, cols]
+
+        self._metrics.frames += 1
+        self._metrics.last_classified = len(changed)
+        self._metrics.misses += len(changed)
+        self._metrics.hits += 64 - len(changed)
+        logger.debug(f"Classified {len(changed)} of 64 squares")
+        return self._probs.copy()
+
+    @property
+    def metrics(self) -> PieceClassificationCacheMetrics:
+        """
+        Get the hit rate and classified square counts of the cache.
+
+        :return: A PieceClassificationCacheMetrics dataclass.
+        """
+        return self._metrics
+
+
+def find_k_best_arrangements(log_probs: list[np.ndarray],
+                             k: int) -> list[tuple[float, list[tuple[int, int]]]]:
+    """
+    Find the k most likely arrangements of independent per-square candidates, in
+    descending joint likelihood.
+
+    :param log_probs: For each square, the log-probabilities of its candidates sorted
+     from most to least likely.
+    :param k: Number of arrangements to find.
+    :return: A list of (joint log-likelihood, deviations) tuples, most likely first.
+     Deviations is a list of (square index, candidate index) pairs for the squares
+     that do not use their most likely candidate.
+    """
+    best = sum(float(lp[0]) for lp in log_probs)
+    # Only squares with alternatives can deviate from the best arrangement. Sorting
+    # them by the cost of their first alternative makes every successor below cost at
+    # least as much as its parent, so arrangements pop off the heap in order and each
+    # one is generated exactly once.
+    deviating = sorted((i for i, lp in enumerate(log_probs) if len(lp) > 1),
+                       key=lambda i: log_probs[i][0] - log_probs[i][1])
+    costs = [[float(log_probs[i][0] - c) for c in log_probs[i]] for i in deviating]
+
+    results = [(best, [])]
+    # Heap entries are (cost, tiebreaker, position in deviating, candidate index,
+    # parent), where parent links the (position, candidate index, parent) deviations
+    # made before this one
+    heap = []
+    if len(deviating) > 0:
+        heappush(heap, (costs[0][1], 0, 0, 1, None))
+    pushed = 1
+    while len(heap) > 0 and len(results) < k:
+        cost, _, pos, cand, parent = heappop(heap)
+        node = (pos, cand, parent)
+
+        deviations = []
+        walk = node
+        while walk is not None:
+            deviations.append((deviating[walk[0]], walk[1]))
+            walk = walk[2]
+        results.append((best - cost, deviations))
+
+        successors = []
+        # Use the next candidate on this square
+        if cand + 1 < len(costs[pos]):
+            successors.append(
+                (cost - costs[pos][cand] + costs[pos][cand + 1], pos, cand + 1, parent))
+        if pos + 1 < len(deviating):
+            # Also deviate on the next square
+            successors.append((cost + costs[pos + 1][1], pos + 1, 1, node))
+            # Deviate on the next square instead of this one
+            if cand == 1:
+                successors.append(
+                    (cost - costs[pos][1] + costs[pos + 1][1], pos + 1, 1, parent))
+        for s_cost, s_pos, s_cand, s_parent in successors:
+            heappush(heap, (s_cost, pushed, s_pos, s_cand, s_parent))
+            pushed += 1
+
+    return results
 
 
 def get_piece_matrix(cb_only: np.ndarray,
                      top_n_confident: int = 5,
-                     return_annotations: bool = False) -> list[GetPieceMatrixResult]:
+                     return_annotations: bool = False,
+                     probs: Optional[np.ndarray] = None) -> list[GetPieceMatrixResult]:
     """
     Get the piece matrix from the chessboard only image.
 
     :param cb_only: Chessboard only image.
     :param top_n_confident: Number of top most confident chessboard arrangements.
-    :param return_annotations: Whether to return an annotated image.
-    :return: A GetPieceMatrixResult dataclass. str will be a "text" representation of
-     the board from the camera's perspective, with newlines for each row. Ex:
-     ```
-     r . b q k b . r
-     p p p p . Q p p
-     . . n . . n . .
-     . . . . p . . .
-     . . B . P . . .
-     . . . . . . . .
-     P P P P . P P P
-     R N B . K . N R
-     ```
+    :param return_annotations: Whether to be able to get an annotated image. It is
+     only drawn when a result's annotation is asked for.
+    :param probs: The probability matrix from classifying the squares, if already
+     done. Otherwise, the squares are classified.
+    :return: A list of GetPieceMatrixResult dataclasses, most confident first. pieces
+     will be an int8[64] array of piece codes indexed by square, with the top of the
+     camera's perspective as rank 8 (see utils.chess_stuff).
     """
-    global colors
-    chessboard_size = cb_only.shape[0]
-    possible_piece_arrangements = []
-    for y in range(8):
-        for x in range(8):
-            x0 = x * chessboard_size // 8
-            y0 = y * chessboard_size // 8
-            x1 = (x + 1) * chessboard_size // 8
-            y1 = (y + 1) * chessboard_size // 8
-            square = cb_only[y0:y1, x0:x1]
-            classify_results = piece_model(square, imgsz=64, verbose=False)
-            probs = classify_results[0].probs
-            # class_name = piece_model.names[probs.top1]
-            # pieces[y, x] = class_name
-
-            possible_pieces = list(zip([piece_model.names[i] for i in probs.top5],
-                                       np.array(probs.top5conf)))
-            possible_to_save = []
-            # if possible_pieces[0][0] == "occluded":
-            #     print(possible_pieces)
-            while sum(c for _, c in possible_to_save) < 0.99 and len(
-                    possible_pieces) > 1:
-                possible_to_save.append(possible_pieces.pop(0))
-            # print(
-            #     f"({x}, {y}) = {[f"{p} {c * 100:.2f}" for p, c in possible_pieces]}")
-            possible_piece_arrangements.append(possible_to_save)
-
-            # if return_annotations:
-            #     cv2.rectangle(annotation, (x0 + 4, y0 + 4), (x1 - 4, y1 - 4),
-            #                   (colors[class_name][2], colors[class_name][1],
-            #                    colors[class_name][0]), 4)
-
-    # pprint(possible_piece_arrangements)
-
-    top_n = []
-    for i, combination in enumerate(product(*possible_piece_arrangements)):
-        if i == top_n_confident:
-            break
-        # print(f"Arrangement {i} {sum(c for _, c in combination) / 64}")
-        top_n.append(combination)
+    if probs is None:
+        probs = classify_squares(cb_only)
+    # Candidate classes of every tile, most likely first, until they cover 99% of
+    # the probability (but at most 4)
+    candidates = []
+    for square_probs in probs:
+        top5 = np.argsort(square_probs)[::-1][:5]
+        cumulative = np.cumsum(square_probs[top5])
+        count = max(1, min(int(np.searchsorted(cumulative, 0.99)) + 1, 4))
+        candidates.append(top5[:count])
+
+    log_probs = [np.log(np.maximum(probs[tile, tile_candidates], 1e-12))
+                 for tile, tile_candidates in enumerate(candidates)]
+    best_classes = np.array([tile_candidates[0] for tile_candidates in candidates])
 
     result = []
-    for combo in top_n:
-        pieces = np.zeros((8, 8), dtype=str)
-        for y in range(8):
-            for x in range(8):
-                class_name = combo[y * 8 + x][0]
-                class_name = class_name if class_name != "empty" else "."
-                class_name = class_name if class_name != "occluded" else "?"
-                pieces[y, x] = class_name
-        confidence = sum(c for _, c in combo) / 64
-        annotation = None
-        if return_annotations:
-            annotation = cb_only.copy()
-            for y in range(8):
-                for x in range(8):
-                    x0 = x * chessboard_size // 8
-                    y0 = y * chessboard_size // 8
-                    x1 = (x + 1) * chessboard_size // 8
-                    y1 = (y + 1) * chessboard_size // 8
-                    class_name = combo[y * 8 + x][0]
-                    cv2.rectangle(annotation, (x0 + 4, y0 + 4), (x1 - 4, y1 - 4),
-                                  (colors[class_name][2], colors[class_name][1],
-                                   colors[class_name][0]), 4)
-        string = ""
-        for row in pieces:
-            string += " ".join(row) + "\n"
-        string = string[:-1]
+    for _, deviations in find_k_best_arrangements(log_probs, top_n_confident):
+        classes = best_classes.copy()
+        for tile, candidate_index in deviations:
+            classes[tile] = candidates[tile][candidate_index]
+        confidence = float(probs[np.arange(64), classes].sum() / 64)
         result.append(
-            GetPieceMatrixResult(pieces=string, confidence=confidence,
-                                 annotation=annotation)
+            GetPieceMatrixResult(pieces=class_codes[classes[tile_of_square]],
+                                 confidence=confidence, classes=classes,
+                                 chessboard=cb_only if return_annotations else None)
         )
 
     return result
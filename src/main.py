@@ -1,16 +1,40 @@
 import sys
 from pathlib import Path
+from time import perf_counter
+
+# Time to the first processed frame is measured from here
+startup_start = perf_counter()
 
 sys.path.append(str(Path.cwd() / "src"))
 
+from utils.startup_stuff import ImportProfiler
+
+# Installed before anything else is imported so every import is timed, which is
+# why the flag is looked for before the arguments are parsed
+import_profiler = ImportProfiler() if "--startup-profile" in sys.argv else None
+if import_profiler is not None:
+    import_profiler.install()
+
 import logging
+import threading
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from queue import Empty
+from time import sleep
+from typing import Optional
 
 import cv2
+import numpy as np
 
-from chessbot import Chessbot
+from chessbot import Chessbot, ChessbotFrameUpdateResult, get_chessboard_preview
+from cv.board import board_model_loader
+from cv.motion import MotionGate
+from cv.pieces import piece_model_loader
 from utils.cv2_stuff import write_text
+from utils.engine_stuff import EngineSuggestion, SuggestionSource
 from utils.logger import create_logger, set_all_stdout_logger_levels
+from utils.metrics_stuff import MetricsServer
+from utils.pipeline_stuff import DropOldestQueue, PipelineStage, StageStats
 
 logger = create_logger(name=__name__, level=logging.DEBUG)
 
@@ -22,6 +46,27 @@ parser.add_argument("--debug-use-image-dir", type=Path, default=None,
 parser.add_argument("--debug-play-image-dir", action="store_true",
                     help="Play images in the specified directory instead of waiting "
                          "for key presses to cycle through. (like a slideshow)")
+parser.add_argument("--legal-move-decoding", action="store_true",
+                    help="Decode moves by scoring every legal move against the piece "
+                         "classifier, instead of matching the most confident "
+                         "arrangements against the board.")
+parser.add_argument("--pipelined", action="store_true",
+                    help="Run capture, inference and rendering in separate threads, "
+                         "always inferring on the freshest frame. With a directory "
+                         "of images, the current image is shown to the bot like a "
+                         "still camera feed.")
+parser.add_argument("--engine-cache", type=Path, default=None,
+                    help="Store engine evaluations in a SQLite database at this path, "
+                         "so positions that come up again in later games are not "
+                         "searched from scratch.")
+parser.add_argument("--metrics-port", type=int, default=None,
+                    help="Serve stage latency histograms and frame result counters "
+                         "in the Prometheus text format at "
+                         "http://127.0.0.1:<port>/metrics.")
+parser.add_argument("--startup-profile", action="store_true",
+                    help="Once the first frame is processed, print how long every "
+                         "import took (like python -X importtime) and the time to "
+                         "the first frame.")
 parser.add_argument("-v", "--verbose", action="store_true",
                     help="Enable verbose logging.")
 args = parser.parse_args()
@@ -31,31 +76,75 @@ if args.verbose:
     set_all_stdout_logger_levels(logging.DEBUG)
 
 debug_play_image_dir = bool(args.debug_play_image_dir)
+pipelined = bool(args.pipelined)
 
 cam = None
 debug_image_dir = Path(args.debug_use_image_dir) if args.debug_use_image_dir else None
 
 if debug_play_image_dir and debug_image_dir is None:
     raise ValueError("You must specify a directory of images to play.")
+if debug_play_image_dir and pipelined:
+    raise ValueError("Playing a directory of images is not supported when "
+                     "pipelined.")
 
-if debug_image_dir is not None:
-    logger.info(f"Using image directory {debug_image_dir} for debugging")
 
-    from utils.fake_picamera2 import FakePicamera2
+def start_camera():
+    if debug_image_dir is not None:
+        logger.info(f"Using image directory {debug_image_dir} for debugging")
 
-    cam = FakePicamera2(debug_image_dir)
-    cam.start()
-else:
-    logger.debug("Using Picamera2")
+        from utils.fake_picamera2 import FakePicamera2
+
+        camera = FakePicamera2(debug_image_dir)
+        camera.start()
+    else:
+        logger.debug("Using Picamera2")
+
+        from picamera2 import Picamera2
+
+        camera = Picamera2()
+        camera.configure(camera.create_video_configuration(
+            main={"format": "RGB888", "size": (800, 606)}))
+        camera.start()
+    return camera
+
+
+# Load and warm up the models, start the camera and spawn the engine all at once,
+# the first update waits for whatever is not ready yet
+board_model_loader.load_async()
+piece_model_loader.load_async()
+with ThreadPoolExecutor(max_workers=1) as executor:
+    camera_future = executor.submit(start_camera)
+    chessbot = Chessbot(legal_move_decoding=args.legal_move_decoding,
+                        # Images in a directory are all different, so they never
+                        # settle unless they are fed continuously
+                        motion_gate=MotionGate()
+                        if debug_image_dir is None or pipelined else None,
+                        render_chessboard_preview=not pipelined,
+                        engine_cache_path=args.engine_cache)
+    cam = camera_future.result()
+logger.info(f"Started in {perf_counter() - startup_start:.2f} s")
+
+metrics_server = None
+if args.metrics_port is not None:
+    metrics_server = MetricsServer(chessbot.metrics_registry, args.metrics_port)
+    metrics_server.start()
 
-    from picamera2 import Picamera2
+first_frame_processed = False
 
-    cam = Picamera2()
-    cam.configure(
-        cam.create_video_configuration(main={"format": "RGB888", "size": (800, 606)}))
-    cam.start()
 
-chessbot = Chessbot()
+def report_first_frame(result: ChessbotFrameUpdateResult):
+    global first_frame_processed
+    # Frames the motion gate waits on are not processed
+    if first_frame_processed or result == ChessbotFrameUpdateResult.MOTION:
+        return
+    first_frame_processed = True
+    first_frame_seconds = perf_counter() - startup_start
+    if import_profiler is not None:
+        import_profiler.uninstall()
+        print(import_profiler.format())
+        logger.info(f"Imports took {import_profiler.total_seconds:.2f} s (summed over "
+                    f"threads)")
+    logger.info(f"Processed first frame {first_frame_seconds:.2f} s after start")
 
 # For testing
 # cam.image_index = 94  # start on white a couple before promotion
@@ -63,66 +152,179 @@ chessbot = Chessbot()
 # frame = cv2.flip(frame, 1)  # Flip horizontally
 # chessbot.update(frame, force_board_sync=True)
 
-while True:
+
+def draw_engine_suggestion(board_preview: np.ndarray,
+                           suggestion: Optional[EngineSuggestion]) -> np.ndarray:
+    if suggestion is None or suggestion.move is None:
+        return board_preview
+    # The preview may be cached by the renderer, so don't draw on it
+    board_preview = board_preview.copy()
+    if suggestion.source == SuggestionSource.ENGINE:
+        score = f" {suggestion.score.white()}" if suggestion.score is not None else ""
+        text = f"{suggestion.move}{score} d{suggestion.depth}"
+    else:
+        text = f"{suggestion.move} ({suggestion.source.value.lower()})"
+    write_text(board_preview, text, 20, 20)
+    return board_preview
+
+
+def capture(_) -> tuple[float, np.ndarray]:
+    if debug_image_dir is not None:
+        # Pretend to be a camera looking at a still image
+        sleep(1 / 30)
     frame = cam.capture_array()
     frame = cv2.flip(frame, 1)  # Flip horizontally
+    return perf_counter(), frame
+
 
+def infer(item: tuple[float, np.ndarray]) -> tuple:
+    captured_at, frame = item
     result = chessbot.update(frame)
-    # logger.debug(f"Chessbot frame update result: {result}")
+    report_first_frame(result)
+    return (captured_at, chessbot.camera_preview.copy(), chessbot.board_snapshot,
+            chessbot.engine_suggestion, result)
 
-    cam_preview = chessbot.camera_preview
-    if debug_image_dir is not None:
-        write_text(cam_preview,
-                   f"Image {cam.image_index + 1}/{cam.max_image_index + 1}", 10, 40)
-    cv2.imshow("Camera preview", cam_preview)
-    cv2.imshow("Chessboard preview", chessbot.chessboard_preview)
 
-    key = ""
-    if debug_image_dir is not None:
-        logger.info("Use 'a' or 's' to go back, 'd' or 'w' to go forward, 'q' to quit.")
-        if debug_play_image_dir:
-            logger.info("Playing images in directory, automatically moving to the "
-                        "next one. If a key specified above is pressed, automatic "
-                        "playback will stop.")
-            key = chr(cv2.waitKey(1) & 0xFF)
-            pressed_key = False
-            if key in ("d", "w"):
-                cam.image_index += 1
-                pressed_key = True
-            elif key in ("a", "s"):
-                cam.image_index -= 1
-                pressed_key = True
-            elif key == "q":
-                pressed_key = True
-                pass
-            else:
-                if cam.image_index < cam.max_image_index:
-                    logger.debug("Automatically moving to next image now")
-                    cam.image_index += 1
-                else:
-                    logger.debug("Reached end, stopping")
-                    debug_play_image_dir = False
-            if pressed_key:
-                logger.info("Key pressed, stopping automatic playback")
-                debug_play_image_dir = False
+def render(item: tuple) -> tuple[float, np.ndarray, np.ndarray]:
+    captured_at, cam_preview, board, suggestion, _ = item
+    return captured_at, cam_preview, draw_engine_suggestion(
+        get_chessboard_preview(board), suggestion)
+
+
+def run_pipelined():
+    stop = threading.Event()
+    # Only ever keep the freshest item between stages
+    frames = DropOldestQueue()
+    results = DropOldestQueue()
+    previews = DropOldestQueue()
+    stages = [
+        PipelineStage("capture", capture, None, frames, stop),
+        PipelineStage("inference", infer, frames, results, stop),
+        PipelineStage("render", render, results, previews, stop)
+    ]
+    for stage in stages:
+        stage.start()
+
+    end_to_end = StageStats("end to end")
+    last_report = perf_counter()
+    while not stop.is_set():
+        try:
+            captured_at, cam_preview, board_preview = previews.get(timeout=0.01)
+        except Empty:
+            pass
         else:
-            while True:
-                key = chr(cv2.waitKey(0) & 0xFF)
+            end_to_end.record(perf_counter() - captured_at)
+            if debug_image_dir is not None:
+                write_text(cam_preview,
+                           f"Image {cam.image_index + 1}/{cam.max_image_index + 1}",
+                           10, 40)
+            cv2.imshow("Camera preview", cam_preview)
+            cv2.imshow("Chessboard preview", board_preview)
+
+        if perf_counter() - last_report > 5:
+            last_report = perf_counter()
+            logger.info(f"Pipeline: {', '.join(str(s.stats) for s in stages)}, "
+                        f"{end_to_end}, dropped {frames.dropped} frames, "
+                        f"{results.dropped} results and {previews.dropped} previews")
+
+        key = chr(cv2.waitKey(1) & 0xFF)
+        if debug_image_dir is not None and key in ("d", "w"):
+            cam.image_index += 1
+        elif debug_image_dir is not None and key in ("a", "s"):
+            cam.image_index -= 1
+        elif key == "q":
+            logger.debug("Exiting")
+            stop.set()
+
+    for stage in stages:
+        stage.join()
+
+
+if pipelined:
+    run_pipelined()
+else:
+    while True:
+        frame = cam.capture_array()
+        frame = cv2.flip(frame, 1)  # Flip horizontally
+
+        result = chessbot.update(frame)
+        report_first_frame(result)
+        # logger.debug(f"Chessbot frame update result: {result}")
+
+        cam_preview = chessbot.camera_preview
+        if debug_image_dir is not None:
+            write_text(cam_preview,
+                       f"Image {cam.image_index + 1}/{cam.max_image_index + 1}", 10, 40)
+        cv2.imshow("Camera preview", cam_preview)
+        cv2.imshow("Chessboard preview",
+                   draw_engine_suggestion(chessbot.chessboard_preview,
+                                          chessbot.engine_suggestion))
+
+        key = ""
+        if debug_image_dir is not None:
+            logger.info("Use 'a' or 's' to go back, 'd' or 'w' to go forward, 'q' to quit.")
+            if debug_play_image_dir:
+                logger.info("Playing images in directory, automatically moving to the "
+                            "next one. If a key specified above is pressed, automatic "
+                            "playback will stop.")
+                key = chr(cv2.waitKey(1) & 0xFF)
+                pressed_key = False
                 if key in ("d", "w"):
                     cam.image_index += 1
+                    pressed_key = True
                 elif key in ("a", "s"):
                     cam.image_index -= 1
+                    pressed_key = True
                 elif key == "q":
+                    pressed_key = True
                     pass
                 else:
-                    print("Unknown key")
-                    continue
-                break
-    else:
-        key = chr(cv2.waitKey(1) & 0xFF)
-    if key == "q":
-        logger.debug("Exiting")
-        break
+                    if cam.image_index < cam.max_image_index:
+                        logger.debug("Automatically moving to next image now")
+                        cam.image_index += 1
+                    else:
+                        logger.debug("Reached end, stopping")
+                        debug_play_image_dir = False
+                if pressed_key:
+                    logger.info("Key pressed, stopping automatic playback")
+                    debug_play_image_dir = False
+            else:
+                while True:
+                    key = chr(cv2.waitKey(0) & 0xFF)
+                    if key in ("d", "w"):
+                        cam.image_index += 1
+                    elif key in ("a", "s"):
+                        cam.image_index -= 1
+                    elif key == "q":
+                        pass
+                    else:
+                        print("Unknown key")
+                        continue
+                    break
+        else:
+            key = chr(cv2.waitKey(1) & 0xFF)
+        if key == "q":
+            logger.debug("Exiting")
+            break
+
+if chessbot.motion_gate_metrics is not None:
+    metrics = chessbot.motion_gate_metrics
+    logger.info(f"Motion gate skipped {metrics.skipped_fraction * 100:.1f}% of "
+                f"{metrics.frames} frames ({metrics})")
+
+if chessbot.piece_cache_metrics is not None:
+    metrics = chessbot.piece_cache_metrics
+    logger.info(f"Piece classification cache hit rate "
+                f"{metrics.hit_rate * 100:.1f}% over {metrics.frames} frames "
+                f"({metrics})")
+
+if chessbot.engine_cache_metrics is not None:
+    metrics = chessbot.engine_cache_metrics
+    logger.info(f"Engine evaluation cache hit rate {metrics.hit_rate * 100:.1f}% "
+                f"({metrics})")
+
+if metrics_server is not None:
+    metrics_server.stop()
 
 cv2.destroyAllWindows()
 cam.stop()
@@ -0,0 +1,135 @@
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path.cwd() / "src"))
+
+import json
+import logging
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from time import perf_counter
+
+import chess.pgn
+import cv2
+
+from utils.logger import create_logger
+
+logger = create_logger(name=__name__, level=logging.DEBUG)
+
+
+@dataclass
+class ReplayResult:
+    name: str
+    frames: int
+    moves: int
+    seconds: float
+    pgn_path: Path
+    frames_path: Path
+
+    @property
+    def fps(self) -> float:
+        """
+        Get the number of frames processed per second.
+
+        :return: Frames per second, or 0 if no time passed.
+        """
+        return self.frames / self.seconds if self.seconds > 0 else 0
+
+
+def replay_directory(image_dir: Path, output_dir: Path,
+                     legal_move_decoding: bool = False) -> ReplayResult:
+    """
+    Run a chessbot over a directory of images without any GUI, and write the game as
+    PGN and the result of every frame as JSONL.
+
+    :param image_dir: Directory of .jpg images, played in sorted order.
+    :param output_dir: Directory to write <name>.pgn and <name>.jsonl to.
+    :param legal_move_decoding: Decode moves by scoring every legal move, like
+     main.py's --legal-move-decoding.
+    :return: A ReplayResult dataclass.
+    """
+    # Imported here so the models are only loaded in the worker processes
+    from chessbot import Chessbot
+    from utils.fake_picamera2 import FakePicamera2
+
+    cam = FakePicamera2(image_dir)
+    cam.start()
+    chessbot = Chessbot(legal_move_decoding=legal_move_decoding,
+                        render_chessboard_preview=False,
+                        annotate_camera_preview=False, use_engine=False)
+
+    name = image_dir.name
+    frames_path = output_dir / f"{name}.jsonl"
+    seconds = 0
+    with open(frames_path, "w") as f:
+        for i in range(cam.max_image_index + 1):
+            cam.image_index = i
+            frame = cam.capture_array()
+            frame = cv2.flip(frame, 1)  # Flip horizontally, like the camera
+
+            plies = len(chessbot.board_snapshot.move_stack)
+            start = perf_counter()
+            result = chessbot.update(frame)
+            elapsed = perf_counter() - start
+            seconds += elapsed
+
+            board = chessbot.board_snapshot
+            f.write(json.dumps({
+                "frame": i,
+                "image": cam.image_path.name,
+                "result": result.value,
+                "moves": [move.uci() for move in board.move_stack[plies:]],
+                "fen": board.fen(),
+                "seconds": elapsed
+            }) + "\n")
+
+    board = chessbot.board_snapshot
+    game = chess.pgn.Game.from_board(board)
+    game.headers["Event"] = name
+    pgn_path = output_dir / f"{name}.pgn"
+    with open(pgn_path, "w") as f:
+        print(game, file=f)
+    chessbot.quit()
+
+    return ReplayResult(name=name, frames=cam.max_image_index + 1,
+                        moves=len(board.move_stack), seconds=seconds,
+                        pgn_path=pgn_path, frames_path=frames_path)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Replay directories of images through the "
+                                        "chessbot without any GUI, writing the games "
+                                        "as PGN and the result of every frame as "
+                                        "JSONL.")
+    parser.add_argument("image_dirs", type=Path, nargs="+",
+                        help="Directories of images to replay, like test/*.")
+    parser.add_argument("-o", "--output-dir", type=Path, default=Path("replays"),
+                        help="Directory to write the PGN and JSONL files to.")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="Number of directories to replay in parallel. Defaults "
+                             "to the number of CPUs.")
+    parser.add_argument("--legal-move-decoding", action="store_true",
+                        help="Decode moves by scoring every legal move against the "
+                             "piece classifier.")
+    args = parser.parse_args()
+    logger.debug(args)
+
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+
+    start = perf_counter()
+    results = []
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {executor.submit(replay_directory, image_dir, args.output_dir,
+                                   args.legal_move_decoding): image_dir
+                   for image_dir in args.image_dirs}
+        for future in as_completed(futures):
+            result = future.result()
+            logger.info(f"{result.name}: {result.moves} moves in {result.frames} "
+                        f"frames at {result.fps:.1f} FPS, wrote {result.pgn_path}")
+            results.append(result)
+    elapsed = perf_counter() - start
+
+    frames = sum(result.frames for result in results)
+    logger.info(f"Replayed {frames} frames of {len(results)} directories in "
+                f"{elapsed:.1f} s ({frames / elapsed:.1f} FPS overall)")
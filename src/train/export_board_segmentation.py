@@ -1,9 +1,12 @@
+import shutil
 from pathlib import Path
 
 from ultralytics import YOLO
 
 model_path = Path.cwd() / "src" / "models" / "board_segmentation_best.pt"
 ncnn_path = Path.cwd() / "src" / "models" / "board_segmentation_best_ncnn_model"
+onnx_path = Path.cwd() / "src" / "models" / "board_segmentation_best.onnx"
+openvino_path = Path.cwd() / "src" / "models" / "board_segmentation_best_openvino_model"
 
 if not ncnn_path.exists():
     print("Exporting model to NCNN format")
@@ -11,3 +14,34 @@ if not ncnn_path.exists():
     model.export(format="ncnn")
 else:
     print("NCNN model already exists, skipping export")
+
+if not onnx_path.exists():
+    print("Exporting model to ONNX format")
+    model = YOLO(model_path)
+    model.export(format="onnx")
+else:
+    print("ONNX model already exists, skipping export")
+
+if not openvino_path.exists():
+    print("Exporting model to OpenVINO format")
+    model = YOLO(model_path)
+    model.export(format="openvino")
+else:
+    print("OpenVINO model already exists, skipping export")
+
+# The NCNN export only runs at the size it was exported at, so the smaller model
+# for CHESSBOT_BOARD_IMGSZ is exported separately under its own name
+low_res_imgsz = 320
+low_res_model_path = model_path.with_name(f"{model_path.stem}_{low_res_imgsz}.pt")
+low_res_ncnn_path = model_path.with_name(f"{model_path.stem}_{low_res_imgsz}_ncnn_model")
+
+if not low_res_ncnn_path.exists():
+    print(f"Exporting model to NCNN format at {low_res_imgsz}")
+    shutil.copy(model_path, low_res_model_path)
+    model = YOLO(low_res_model_path)
+    model.export(format="ncnn", imgsz=low_res_imgsz)
+    model.export(format="onnx", imgsz=low_res_imgsz)
+    model.export(format="openvino", imgsz=low_res_imgsz)
+    low_res_model_path.unlink()
+else:
+    print(f"NCNN model at {low_res_imgsz} already exists, skipping export")
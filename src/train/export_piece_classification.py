@@ -4,6 +4,8 @@ from ultralytics import YOLO
 
 piece_classify_model_path = Path.cwd() / "src" / "models" / "piece_classification_best.pt"
 piece_classify_ncnn_path = Path.cwd() / "src" / "models" / "piece_classification_best_ncnn_model"
+piece_classify_onnx_path = Path.cwd() / "src" / "models" / "piece_classification_best.onnx"
+piece_classify_openvino_path = Path.cwd() / "src" / "models" / "piece_classification_best_openvino_model"
 
 if not piece_classify_ncnn_path.exists():
     print("Exporting piece classification model to NCNN format")
@@ -11,3 +13,18 @@ if not piece_classify_ncnn_path.exists():
     piece_model.export(format="ncnn")
 else:
     print("NCNN piece classification model already exists, skipping export")
+
+# Dynamic so all 64 squares are classified in one call
+if not piece_classify_onnx_path.exists():
+    print("Exporting piece classification model to ONNX format")
+    piece_model = YOLO(piece_classify_model_path)
+    piece_model.export(format="onnx", dynamic=True)
+else:
+    print("ONNX piece classification model already exists, skipping export")
+
+if not piece_classify_openvino_path.exists():
+    print("Exporting piece classification model to OpenVINO format")
+    piece_model = YOLO(piece_classify_model_path)
+    piece_model.export(format="openvino", dynamic=True)
+else:
+    print("OpenVINO piece classification model already exists, skipping export")
@@ -12,8 +12,8 @@ import cv2
 import numpy as np
 from picamera2 import Picamera2
 from shapely import Polygon
-from ultralytics import YOLO
 
+from cv.board import board_model_loader
 from utils.cv2_stuff import crop_and_reshape_to_square, draw_polygon, \
     get_tile_in_image, write_text
 from utils.math_stuff import find_closest_to_right_angles
@@ -35,9 +35,7 @@ target_directory.mkdir(parents=True, exist_ok=True)
 
 print(f"Capturing images for {target_piece} to {target_directory}")
 
-ncnn_path = Path.cwd() / "src" / "models" / "board_segmentation_best_ncnn_model"
-
-model = YOLO(ncnn_path, task="segment")
+model = board_model_loader.model
 
 cam = Picamera2()
 cam.configure(
@@ -57,14 +55,6 @@ chessboard_size = 512
 current_square = 0
 print(f"Place {target_piece} on {current_square % 8}, {current_square // 8}")
 
-# idfk why this is needed
-try:
-    model(np.zeros((640, 640, 3), dtype=np.uint8))
-except TypeError:
-    print("Model loaded")
-    pass
-model(np.zeros((640, 640, 3), dtype=np.uint8))
-
 while True:
     frame = cam.capture_array()
 
@@ -72,9 +62,8 @@ while True:
     chessboard_only = None
     chessboard_annotations = None
 
-    results = model(frame, verbose=False)
-    if results[0].masks is not None:
-        mask = results[0].masks.xy[0]
+    mask = model.segment(frame)
+    if mask is not None:
 
         pg = Polygon(mask).simplify(tolerance=20)
         rectangularity = pg.area / pg.minimum_rotated_rectangle.area
@@ -11,8 +11,8 @@ import cv2
 import numpy as np
 from shapely import Polygon
 from tqdm import trange
-from ultralytics import YOLO
 
+from cv.board import board_model_loader
 from utils.cv2_stuff import crop_and_reshape_to_square, draw_polygon, \
     get_tile_in_image, write_text
 from utils.math_stuff import find_closest_to_right_angles
@@ -37,9 +37,7 @@ auto = bool(args.auto)
 
 print(f"Capturing images to {output_image_dir}")
 
-ncnn_path = Path.cwd() / "src" / "models" / "board_segmentation_best_ncnn_model"
-
-model = YOLO(ncnn_path, task="segment")
+model = board_model_loader.model
 
 from utils.fake_picamera2 import FakePicamera2
 
@@ -56,14 +54,6 @@ def save_np_image(image: np.ndarray):
 
 chessboard_size = 512
 
-# idfk why this is needed
-try:
-    model(np.zeros((640, 640, 3), dtype=np.uint8))
-except TypeError:
-    print("Model loaded")
-    pass
-model(np.zeros((640, 640, 3), dtype=np.uint8))
-
 while True:
     frame = cam.capture_array()
     frame = cv2.flip(frame, 1)  # Flip horizontally
@@ -72,9 +62,8 @@ while True:
     chessboard_only = None
     chessboard_annotations = None
 
-    results = model(frame, verbose=False)
-    if results[0].masks is not None:
-        mask = results[0].masks.xy[0]
+    mask = model.segment(frame)
+    if mask is not None:
 
         pg = Polygon(mask).simplify(tolerance=20)
         rectangularity = pg.area / pg.minimum_rotated_rectangle.area
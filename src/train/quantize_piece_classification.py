@@ -0,0 +1,195 @@
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path.cwd() / "src"))
+
+import json
+from argparse import ArgumentParser
+from time import perf_counter
+
+import cv2
+import numpy as np
+import onnxruntime
+from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, \
+    quantize_static
+from onnxruntime.quantization.shape_inference import quant_pre_process
+
+from cv.board import GetChessboardOnlyResultType, get_chessboard_only
+from cv.inference import Classifier, ONNXRuntimeBackend, read_model_metadata
+from cv.models import models_path
+from cv.pieces import get_square_batch, piece_classify_ncnn_path, piece_classify_stem
+
+parser = ArgumentParser(description="Quantize the piece classification model to "
+                                    "INT8, calibrated with squares from directories "
+                                    "of recorded games, and compare it with the FP32 "
+                                    "model on held out games.")
+parser.add_argument("-i", "--image-dirs", type=Path, nargs="+",
+                    default=sorted(p for p in (Path.cwd() / "test").iterdir()
+                                   if p.is_dir()),
+                    help="Directories of recorded games, like the ones in test. "
+                         "Defaults to every directory in test.")
+parser.add_argument("--held-out", type=float, default=0.3,
+                    help="Fraction of the directories only used to compare the "
+                         "models, and not to calibrate. Defaults to 0.3.")
+parser.add_argument("-l", "--labeled-dir", type=Path, default=None,
+                    help="A piece dataset split with a directory of images per "
+                         "class, like the test split downloaded from Roboflow, to "
+                         "measure the accuracy of both models on.")
+parser.add_argument("-c", "--calibration-boards", type=int, default=64,
+                    help="Maximum number of boards (64 squares each) to calibrate "
+                         "with. Defaults to 64.")
+parser.add_argument("-r", "--repeat", type=int, default=20,
+                    help="How many times to time each model on a board.")
+parser.add_argument("-f", "--force", action="store_true",
+                    help="Quantize again even if the INT8 model already exists.")
+args = parser.parse_args()
+print(args)
+if not 0 < args.held_out < 1:
+    parser.error("--held-out must be between 0 and 1")
+if args.calibration_boards < 1:
+    parser.error("--calibration-boards must be at least 1")
+
+fp32_path = ONNXRuntimeBackend.model_path(models_path, piece_classify_stem)
+int8_path = ONNXRuntimeBackend.model_path(models_path, f"{piece_classify_stem}_int8")
+report_path = models_path / f"{piece_classify_stem}_int8_report.json"
+if not fp32_path.exists():
+    print(f"{fp32_path} does not exist, run export_piece_classification.py first")
+    sys.exit(1)
+metadata = read_model_metadata(piece_classify_ncnn_path)
+
+
+def get_boards(image_dir: Path) -> list[np.ndarray]:
+    boards = []
+    for image_path in sorted(image_dir.glob("*.jpg")):
+        frame = cv2.flip(cv2.imread(str(image_path)), 1)
+        result = get_chessboard_only(frame)
+        if result.result_type == GetChessboardOnlyResultType.CHESSBOARD_FOUND:
+            boards.append(get_square_batch(result.chessboard))
+    return boards
+
+
+# Whole games are held out, since frames of the same game look alike
+held_out_count = max(1, round(len(args.image_dirs) * args.held_out))
+calibration_dirs = args.image_dirs[:-held_out_count]
+held_out_dirs = args.image_dirs[-held_out_count:]
+if len(calibration_dirs) == 0:
+    print(f"All {len(args.image_dirs)} directories are held out, so there is "
+          f"nothing to calibrate with. Pass more directories with -i or lower "
+          f"--held-out")
+    sys.exit(1)
+print(f"Calibrating with {', '.join(d.name for d in calibration_dirs)}")
+print(f"Comparing on {', '.join(d.name for d in held_out_dirs)}")
+calibration_boards = [board for d in calibration_dirs for board in get_boards(d)]
+held_out_boards = [board for d in held_out_dirs for board in get_boards(d)]
+if len(calibration_boards) > args.calibration_boards:
+    rng = np.random.default_rng(0)
+    picked = rng.choice(len(calibration_boards), args.calibration_boards,
+                        replace=False)
+    calibration_boards = [calibration_boards[i] for i in sorted(picked)]
+print(f"Found {len(calibration_boards)} calibration boards and "
+      f"{len(held_out_boards)} held out boards")
+if len(calibration_boards) == 0:
+    print("No chessboard was found in the calibration directories")
+    sys.exit(1)
+if len(held_out_boards) == 0:
+    print("No chessboard was found in the held out directories")
+    sys.exit(1)
+
+
+class SquareCalibrationReader(CalibrationDataReader):
+    def __init__(self, input_name: str, boards: list[np.ndarray]):
+        self._input_name = input_name
+        self._boards = iter(boards)
+
+    def get_next(self) -> dict | None:
+        board = next(self._boards, None)
+        return {self._input_name: board} if board is not None else None
+
+
+if args.force or not int8_path.exists():
+    print(f"Quantizing {fp32_path} to {int8_path}")
+    preprocessed_path = int8_path.with_suffix(".preprocessed.onnx")
+    quant_pre_process(str(fp32_path), str(preprocessed_path))
+    input_name = onnxruntime.InferenceSession(
+        str(fp32_path), providers=["CPUExecutionProvider"]).get_inputs()[0].name
+    start = perf_counter()
+    # Weights per channel, which keeps the small convolutions accurate
+    quantize_static(str(preprocessed_path), str(int8_path),
+                    SquareCalibrationReader(input_name, calibration_boards),
+                    quant_format=QuantFormat.QDQ, per_channel=True,
+                    activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+    preprocessed_path.unlink()
+    print(f"Quantized in {perf_counter() - start:.2f} s")
+else:
+    print(f"{int8_path} already exists, skipping quantization")
+
+models = {
+    "fp32": Classifier(ONNXRuntimeBackend(fp32_path), metadata),
+    "int8": Classifier(ONNXRuntimeBackend(int8_path), metadata)
+}
+for model in models.values():
+    model.warm_up()
+
+report = {
+    "calibration_dirs": [d.name for d in calibration_dirs],
+    "held_out_dirs": [d.name for d in held_out_dirs],
+    "calibration_boards": len(calibration_boards),
+    "held_out_boards": len(held_out_boards),
+    "size_mb": {"fp32": fp32_path.stat().st_size / 1e6,
+                "int8": int8_path.stat().st_size / 1e6}
+}
+
+# Latency of classifying all 64 squares of a board
+latencies = {name: [] for name in models}
+predictions = {name: [] for name in models}
+for board in held_out_boards:
+    for name, model in models.items():
+        for _ in range(args.repeat):
+            start = perf_counter()
+            probs = model.classify(board)
+            latencies[name].append(perf_counter() - start)
+        predictions[name].append(probs.argmax(axis=1))
+report["latency_ms"] = {
+    name: {"median": float(np.median(times) * 1000),
+           "p95": float(np.percentile(times, 95) * 1000)}
+    for name, times in latencies.items()
+}
+# The recorded games are not labeled, so there the FP32 model is the reference
+report["held_out_agreement"] = float(np.mean(
+    np.concatenate(predictions["fp32"]) == np.concatenate(predictions["int8"])))
+
+if args.labeled_dir is not None:
+    class_indices = {name: i for i, name in metadata["names"].items()}
+    height, width = metadata["imgsz"]
+    images, labels = [], []
+    for class_dir in sorted(p for p in args.labeled_dir.iterdir() if p.is_dir()):
+        for image_path in sorted(class_dir.glob("*.jpg")):
+            image = cv2.resize(cv2.imread(str(image_path)), (width, height),
+                               interpolation=cv2.INTER_AREA)
+            images.append(image[..., ::-1].transpose(2, 0, 1) / np.float32(255))
+            labels.append(class_indices[class_dir.name])
+    labels = np.array(labels)
+    batch = np.stack(images).astype(np.float32)
+    report["labeled_images"] = len(labels)
+    report["labeled_accuracy"] = {
+        name: float(np.mean(np.concatenate([
+            model.classify(batch[i:i + 64]).argmax(axis=1)
+            for i in range(0, len(batch), 64)
+        ]) == labels))
+        for name, model in models.items()
+    }
+
+for name in models:
+    line = f"{name}: {report['size_mb'][name]:.2f} MB, median " \
+           f"{report['latency_ms'][name]['median']:.2f} ms, p95 " \
+           f"{report['latency_ms'][name]['p95']:.2f} ms per board"
+    if "labeled_accuracy" in report:
+        line += f", accuracy {report['labeled_accuracy'][name] * 100:.2f}%"
+    print(line)
+speedup = report["latency_ms"]["fp32"]["median"] / report["latency_ms"]["int8"]["median"]
+print(f"INT8 speedup: {speedup:.2f}x")
+print(f"Held out top-1 agreement with FP32: "
+      f"{report['held_out_agreement'] * 100:.2f}%")
+with open(report_path, "w") as f:
+    json.dump(report, f, indent=2)
+print(f"Saved report to {report_path}")
@@ -0,0 +1,145 @@
+from typing import Optional
+
+import chess
+import chess.svg
+import numpy as np
+
+from utils.cv2_stuff import svg_to_numpy
+
+# Geometry of chess.svg.board with coordinates and without borders
+SVG_SQUARE_SIZE = 45
+SVG_MARGIN = 15
+SVG_FULL_SIZE = 2 * SVG_MARGIN + 8 * SVG_SQUARE_SIZE
+
+LASTMOVE_LIGHT_COLOR = "#cdd16a"
+LASTMOVE_DARK_COLOR = "#aaa23b"
+CHECK_COLOR = "#CC0000CC"
+
+
+def hex_to_bgr(color: str) -> tuple[np.ndarray, float]:
+    """
+    Convert a hex color like chess.svg uses to BGR and opacity.
+
+    :param color: A color like "#cdd16a" or "#CC0000CC".
+    :return: A tuple of the BGR color as a float array and the opacity from 0 to 1.
+    """
+    color = color.lstrip("#")
+    r, g, b = (int(color[i:i + 2], 16) for i in (0, 2, 4))
+    opacity = int(color[6:8], 16) / 255 if len(color) == 8 else 1
+    return np.array([b, g, r], dtype=np.float32), opacity
+
+
+class BoardPreviewRenderer:
+    def __init__(self, size: int = 512):
+        """
+        Renders boards like chess.svg.board, but by compositing piece sprites onto a
+        board background that are only rasterized once.
+
+        :param size: Size of the rendered board in pixels. Defaults to 512.
+        """
+        self._size = size
+        scale = size / SVG_FULL_SIZE
+        self._edges = [round((SVG_MARGIN + i * SVG_SQUARE_SIZE) * scale)
+                       for i in range(9)]
+        self._sprite_size = round(SVG_SQUARE_SIZE * scale)
+        self._background = svg_to_numpy(chess.svg.board(size=size)).astype(
+            np.float32)
+        # Piece to (premultiplied color, 1 - alpha) at the sprite size
+        self._sprites: dict[tuple[chess.Piece, int, int], tuple[
+            np.ndarray, np.ndarray]] = {}
+        self._last_key: Optional[tuple] = None
+        self._last_image: Optional[np.ndarray] = None
+
+    def _square_bounds(self, square: chess.Square) -> tuple[int, int, int, int]:
+        """
+        Get the pixel bounds of a square, with white at the bottom.
+
+        :param square: The square.
+        :return: A tuple of (x0, y0, x1, y1), exclusive of x1 and y1.
+        """
+        col = chess.square_file(square)
+        row = 7 - chess.square_rank(square)
+        return (self._edges[col], self._edges[row], self._edges[col + 1],
+                self._edges[row + 1])
+
+    def _rasterize_piece(self, piece: chess.Piece,
+                         background: str) -> np.ndarray:
+        """
+        Rasterize a piece on a solid background.
+
+        :param piece: The piece.
+        :param background: The background color, like "#000".
+        :return: A sprite size by sprite size BGR image as floats.
+        """
+        svg = chess.svg.piece(piece, size=self._sprite_size)
+        # Put a background behind the piece, right after the opening svg tag
+        tag_end = svg.index(">") + 1
+        svg = (svg[:tag_end] +
+               f'<rect width="{SVG_SQUARE_SIZE}" height="{SVG_SQUARE_SIZE}" '
+               f'fill="{background}" />' + svg[tag_end:])
+        return svg_to_numpy(svg)[:self._sprite_size, :self._sprite_size].astype(
+            np.float32)
+
+    def _get_sprite(self, piece: chess.Piece, width: int,
+                    height: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Get a piece sprite, rasterizing it the first time.
+
+        :param piece: The piece.
+        :param width: Width of the square the sprite goes on.
+        :param height: Height of the square the sprite goes on.
+        :return: A tuple of the color premultiplied by alpha and of 1 - alpha.
+        """
+        key = (piece, width, height)
+        if key not in self._sprites:
+            # The difference between the piece on black and on white gives alpha
+            on_black = self._rasterize_piece(piece, "#000")
+            on_white = self._rasterize_piece(piece, "#fff")
+            transparency = np.mean(on_white - on_black, axis=2, keepdims=True) / 255
+            transparency = np.clip(transparency, 0, 1)
+            sprite = np.zeros((height, width, 3), dtype=np.float32)
+            sprite_transparency = np.ones((height, width, 1), dtype=np.float32)
+            h = min(height, self._sprite_size)
+            w = min(width, self._sprite_size)
+            sprite[:h, :w] = on_black[:h, :w]
+            sprite_transparency[:h, :w] = transparency[:h, :w]
+            self._sprites[key] = (sprite, sprite_transparency)
+        return self._sprites[key]
+
+    def render(self, board: chess.Board) -> np.ndarray:
+        """
+        Render a board with its last move and check highlighted. Rendering the same
+        position again costs nothing.
+
+        :param board: The board to render.
+        :return: A size by size BGR image of the board.
+        """
+        # Find the last move and highlight it
+        last_move = board.peek() if len(board.move_stack) > 0 else None
+        # Find which king is in check
+        check_square = board.king(board.turn) if board.is_check() else None
+
+        key = (board.board_fen(), last_move, check_square)
+        if key == self._last_key:
+            return self._last_image
+
+        image = self._background.copy()
+        if last_move is not None:
+            for square in (last_move.from_square, last_move.to_square):
+                x0, y0, x1, y1 = self._square_bounds(square)
+                light = bool(chess.BB_LIGHT_SQUARES & chess.BB_SQUARES[square])
+                color, _ = hex_to_bgr(LASTMOVE_LIGHT_COLOR if light
+                                      else LASTMOVE_DARK_COLOR)
+                image[y0:y1, x0:x1] = color
+        if check_square is not None:
+            x0, y0, x1, y1 = self._square_bounds(check_square)
+            color, opacity = hex_to_bgr(CHECK_COLOR)
+            image[y0:y1, x0:x1] = image[y0:y1, x0:x1] * (1 - opacity) + color * opacity
+        for square, piece in board.piece_map().items():
+            x0, y0, x1, y1 = self._square_bounds(square)
+            sprite, transparency = self._get_sprite(piece, x1 - x0, y1 - y0)
+            image[y0:y1, x0:x1] = sprite + image[y0:y1, x0:x1] * transparency
+
+        self._last_key = key
+        self._last_image = np.rint(image).astype(np.uint8)
+        return self._last_image
@@ -1,38 +1,132 @@
 import logging
 from dataclasses import dataclass
 from enum import Enum
+from typing import Optional
 
 import chess
-import chess.svg
+import numpy as np
 
 from utils.logger import create_logger
 
 logger = create_logger(name=__name__, level=logging.DEBUG)
 
 
+# Arrangements are int8[64] arrays of piece codes indexed by square (a1 is 0): 0 for
+# empty, the piece type for white pieces, minus the piece type for black pieces
+EMPTY_CODE = 0
+UNKNOWN_CODE = 127
+
+CODE_PIECES = {color_sign * piece_type: chess.Piece(piece_type, color)
+               for color, color_sign in ((chess.WHITE, 1), (chess.BLACK, -1))
+               for piece_type in chess.PIECE_TYPES}
+piece_codes = np.array(list(CODE_PIECES.keys()), dtype=np.int16)
+
+
+def piece_to_code(piece: Optional[chess.Piece]) -> int:
+    """
+    Get the piece code of a piece.
+
+    :param piece: The piece, or None for an empty square.
+    :return: The piece code.
+    """
+    if piece is None:
+        return EMPTY_CODE
+    return piece.piece_type if piece.color == chess.WHITE else -piece.piece_type
+
+
+def symbol_to_code(symbol: str) -> int:
+    """
+    Get the piece code of a symbol like str(board) uses.
+
+    :param symbol: A piece symbol like "P" or "k", "." for empty or "?" for unknown.
+    :return: The piece code.
+    """
+    if symbol == ".":
+        return EMPTY_CODE
+    if symbol == "?":
+        return UNKNOWN_CODE
+    return piece_to_code(chess.Piece.from_symbol(symbol))
+
+
+def board_to_arrangement(board: chess.Board) -> np.ndarray:
+    """
+    Get the arrangement of the pieces on a board.
+
+    :param board: The board.
+    :return: An int8[64] array of piece codes indexed by square.
+    """
+    masks = np.array([board.pieces_mask(piece.piece_type, piece.color)
+                      for piece in CODE_PIECES.values()], dtype="<u8")
+    squares = np.unpackbits(masks.view(np.uint8), bitorder="little").reshape(-1, 64)
+    return (piece_codes @ squares).astype(np.int8)
+
+
+def arrangement_to_string(arrangement: np.ndarray) -> str:
+    """
+    Get a text representation of an arrangement like str(board), with "?" for
+    unknown squares. Only meant for logging.
+
+    :param arrangement: An int8[64] array of piece codes indexed by square.
+    :return: The rows from rank 8 to rank 1, separated by newlines.
+    """
+    rows = []
+    for rank in range(7, -1, -1):
+        row = []
+        for code in arrangement[rank * 8:rank * 8 + 8]:
+            if code == EMPTY_CODE:
+                row.append(".")
+            elif code == UNKNOWN_CODE:
+                row.append("?")
+            else:
+                row.append(CODE_PIECES[int(code)].symbol())
+        rows.append(" ".join(row))
+    return "\n".join(rows)
+
+
 def board_sync_from_chessboard_arrangement(board: chess.Board,
-                                           arrangement: str) -> chess.SquareSet:
+                                           arrangement: np.ndarray) -> chess.SquareSet:
     """
-    Given a string representation of a chess board, reset the board to match the
-    arrangement.
+    Given an arrangement of a chess board, reset the board to match the arrangement.
 
     :param board: The board to set.
-    :param arrangement: A string representation of the board. NOT a FEN or PGN.
+    :param arrangement: An int8[64] array of piece codes indexed by square.
     :return: A set of squares that are unknown.
     """
-    ss = chess.SquareSet()
     board.clear()
-    rows = arrangement.strip().split('\n')
-    for row_index, row in enumerate(rows):
-        for col_index, piece in enumerate(row.split(" ")):
-            if piece not in (".", "?"):
-                square = chess.square(col_index, 7 - row_index)
-                board.set_piece_at(square, chess.Piece.from_symbol(piece))
-            else:
-                if piece == "?":
-                    ss.add(chess.square(col_index, 7 - row_index))
-                board.remove_piece_at(chess.square(col_index, 7 - row_index))
-    return ss
+    for square in np.flatnonzero((arrangement != EMPTY_CODE) &
+                                 (arrangement != UNKNOWN_CODE)):
+        board.set_piece_at(int(square), CODE_PIECES[int(arrangement[square])])
+    return chess.SquareSet(int(square)
+                           for square in np.flatnonzero(arrangement == UNKNOWN_CODE))
+
+
+def get_move_changes(board: chess.Board,
+                     move: chess.Move) -> list[tuple[chess.Square, Optional[chess.Piece]]]:
+    """
+    Get the squares a legal move changes and what is on them after the move, without
+    pushing it.
+
+    :param board: The board the move is played on.
+    :param move: A legal move on the board.
+    :return: A list of (square, piece or None if empty) pairs.
+    """
+    piece = board.piece_at(move.from_square)
+    changes = [(move.from_square, None)]
+    if board.is_castling(move):
+        rank = chess.square_rank(move.from_square)
+        if board.is_kingside_castling(move):
+            rook_from, rook_to = chess.square(7, rank), chess.square(5, rank)
+        else:
+            rook_from, rook_to = chess.square(0, rank), chess.square(3, rank)
+        changes.append((rook_from, None))
+        changes.append((rook_to, chess.Piece(chess.ROOK, piece.color)))
+    elif board.is_en_passant(move):
+        changes.append((chess.square(chess.square_file(move.to_square),
+                                     chess.square_rank(move.from_square)), None))
+    if move.promotion is not None:
+        piece = chess.Piece(move.promotion, piece.color)
+    changes.append((move.to_square, piece))
+    return changes
 
 
 class ChessboardDifferenceType(Enum):
@@ -40,53 +134,38 @@ class ChessboardDifferenceType(Enum):
     REMOVE = "REMOVE"
 
 
-@dataclass
+@dataclass(slots=True)
 class ChessboardDifference:
     type: ChessboardDifferenceType
     square: chess.Square
     piece: chess.Piece
 
 
-def find_chessboard_differences(old: str, new: str) -> list[ChessboardDifference]:
+def find_chessboard_differences(old: np.ndarray,
+                                new: np.ndarray) -> list[ChessboardDifference]:
     """
-    Given two string representations of a chess board, find the differences between them.
+    Given two arrangements of a chess board, find the differences between them.
 
-    :param old: Old board arrangement.
-    :param new: New board arrangement.
-    :return: A list of differences.
+    :param old: Old board arrangement, an int8[64] array of piece codes indexed by
+     square.
+    :param new: New board arrangement, an int8[64] array of piece codes indexed by
+     square.
+    :return: A list of differences, with a square's removal before its addition.
     :raises ValueError: If unknown squares are compared.
     """
+    if np.any(old == UNKNOWN_CODE) or np.any(new == UNKNOWN_CODE):
+        raise ValueError("Unknown squares should not be compared")
     differences = []
-    old_rows = old.strip().split('\n')
-    new_rows = new.strip().split('\n')
-    for row_index, (old_row, new_row) in enumerate(zip(old_rows, new_rows)):
-        for col_index, (old_piece, new_piece) in enumerate(
-                zip(old_row.split(" "), new_row.split(" "))):
-            if old_piece == "?" or new_piece == "?":
-                raise ValueError("Unknown squares should not be compared")
-            if old_piece != new_piece:
-                square = chess.square(col_index, 7 - row_index)
-                if old_piece == ".":
-                    differences.append(
-                        ChessboardDifference(type=ChessboardDifferenceType.ADD,
-                                             square=square,
-                                             piece=chess.Piece.from_symbol(
-                                                 new_piece)))
-                elif new_piece == ".":
-                    differences.append(
-                        ChessboardDifference(type=ChessboardDifferenceType.REMOVE,
-                                             square=square,
-                                             piece=chess.Piece.from_symbol(
-                                                 old_piece)))
-                else:
-                    differences.append(
-                        ChessboardDifference(type=ChessboardDifferenceType.REMOVE,
-                                             square=square,
-                                             piece=chess.Piece.from_symbol(
-                                                 old_piece)))
-                    differences.append(
-                        ChessboardDifference(type=ChessboardDifferenceType.ADD,
-                                             square=square,
-                                             piece=chess.Piece.from_symbol(
-                                                 new_piece)))
+    for square in np.flatnonzero(old != new):
+        square = int(square)
+        if old[square] != EMPTY_CODE:
+            differences.append(
+                ChessboardDifference(type=ChessboardDifferenceType.REMOVE,
+                                     square=square,
+                                     piece=CODE_PIECES[int(old[square])]))
+        if new[square] != EMPTY_CODE:
+            differences.append(
+                ChessboardDifference(type=ChessboardDifferenceType.ADD,
+                                     square=square,
+                                     piece=CODE_PIECES[int(new[square])]))
     return differences
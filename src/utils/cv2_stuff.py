@@ -1,18 +1,18 @@
 from functools import lru_cache
 from io import BytesIO, StringIO
-from typing import Union
+from typing import TYPE_CHECKING, Optional, Union
 
 import cv2
 import numpy as np
-from reportlab.graphics import renderPM
-from shapely.geometry.polygon import Polygon
-from svglib.svglib import svg2rlg
 
+if TYPE_CHECKING:
+    from shapely.geometry.polygon import Polygon
 
-def draw_polygon(pg: Union[Polygon, np.ndarray], image: np.ndarray, pt_size: int = 5,
+
+def draw_polygon(pg: Union["Polygon", np.ndarray], image: np.ndarray, pt_size: int = 5,
                  pt_color: tuple = (0, 255, 0), line_color: tuple = (0, 255, 0),
                  line_width: int = 2) -> np.ndarray:
-    if isinstance(pg, Polygon):
+    if hasattr(pg, "exterior"):  # A shapely Polygon
         pg = pg.exterior.coords
     for i, pt in enumerate(pg):
         x, y = pt
@@ -30,8 +30,7 @@ def draw_polygon(pg: Union[Polygon, np.ndarray], image: np.ndarray, pt_size: int
     return image
 
 
-def crop_and_reshape_to_square(image: np.ndarray, points: np.ndarray,
-                               size: int) -> np.ndarray:
+def get_square_perspective_transform(points: np.ndarray, size: int) -> np.ndarray:
     # Define the destination points for the square image
     dst_points = np.array([
         [size - 1, 0],
@@ -41,7 +40,12 @@ def crop_and_reshape_to_square(image: np.ndarray, points: np.ndarray,
     ], dtype="float32")
 
     # Compute the perspective transformation matrix
-    M = cv2.getPerspectiveTransform(points, dst_points)
+    return cv2.getPerspectiveTransform(points, dst_points)
+
+
+def crop_and_reshape_to_square(image: np.ndarray, points: np.ndarray,
+                               size: int) -> np.ndarray:
+    M = get_square_perspective_transform(points, size)
 
     # Apply the perspective transformation
     square_image = cv2.warpPerspective(image, M, (size, size))
@@ -49,6 +53,84 @@ def crop_and_reshape_to_square(image: np.ndarray, points: np.ndarray,
     return square_image
 
 
+def refine_corners(gray: np.ndarray, corners: np.ndarray,
+                   search_radius: int) -> np.ndarray:
+    """
+    Refine rough corners to sub-pixel accuracy with cv2.cornerSubPix, which moves
+    each one to where the edges around it meet.
+
+    :param gray: The full resolution grayscale image.
+    :param corners: An (N, 2) float32 array of rough corners.
+    :param search_radius: How far in pixels the rough corners may be off. Corners
+     that move further than this are left where they were, since they were pulled
+     towards another edge.
+    :return: An (N, 2) float32 array of the refined corners.
+    """
+    refined = cv2.cornerSubPix(
+        gray, corners.reshape(-1, 1, 2).copy(), (search_radius, search_radius),
+        (-1, -1), (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_COUNT, 30, 0.01)
+    ).reshape(-1, 2)
+    moved_too_far = np.linalg.norm(refined - corners, axis=1) > search_radius
+    refined[moved_too_far] = corners[moved_too_far]
+    return refined
+
+
+class PerspectiveWarper:
+    def __init__(self, size: int = 512):
+        """
+        Warps images to a square into a reused buffer. The remap maps of the last
+        perspective are kept, so warping with the same perspective again only has to
+        sample the image.
+
+        :param size: Size of the square output. Defaults to 512.
+        """
+        self._size = size
+        self._buffer = np.empty((size, size, 3), dtype=np.uint8)
+        self._perspective: Optional[np.ndarray] = None
+        self._maps: Optional[tuple[np.ndarray, np.ndarray]] = None
+
+    def _update_maps(self, perspective: np.ndarray):
+        # For every output pixel, where it comes from in the input
+        xs, ys = np.meshgrid(np.arange(self._size, dtype=np.float64),
+                             np.arange(self._size, dtype=np.float64))
+        points = np.stack([xs, ys, np.ones_like(xs)], axis=-1) @ \
+            np.linalg.inv(perspective).T
+        map_x = (points[..., 0] / points[..., 2]).astype(np.float32)
+        map_y = (points[..., 1] / points[..., 2]).astype(np.float32)
+        self._maps = cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+        self._perspective = perspective.copy()
+
+    def warp(self, image: np.ndarray, perspective: np.ndarray) -> np.ndarray:
+        """
+        Warp an image with a perspective transform.
+
+        :param image: The image to warp.
+        :param perspective: The perspective matrix, like from
+         get_square_perspective_transform.
+        :return: The warped image. It is overwritten by the next warp, so copy it to
+         keep it.
+        """
+        if self._perspective is None or \
+                not np.array_equal(perspective, self._perspective):
+            self._update_maps(perspective)
+        return cv2.remap(image, self._maps[0], self._maps[1], cv2.INTER_LINEAR,
+                         dst=self._buffer)
+
+
+def get_tile_view(image: np.ndarray, rows: int = 8, cols: int = 8) -> np.ndarray:
+    """
+    Get the tiles of an image as a view, without copying.
+
+    :param image: The image, which must be contiguous and whose size must be a
+     multiple of the number of tiles.
+    :param rows: Number of rows of tiles. Defaults to 8.
+    :param cols: Number of columns of tiles. Defaults to 8.
+    :return: A (rows, cols, tile height, tile width, channels) view of the image.
+    """
+    height, width = image.shape[0] // rows, image.shape[1] // cols
+    return image.reshape(rows, height, cols, width, -1).swapaxes(1, 2)
+
+
 def get_tile_in_image(image: np.ndarray, row: int, col: int, rows: int = 8,
                       cols: int = 8) -> np.ndarray:
     x0 = col * image.shape[1] // cols
@@ -92,6 +174,10 @@ def write_text(image: np.ndarray, text: str, x: int = 10, y: int = 10):
 
 @lru_cache(maxsize=32)
 def svg_to_numpy(svg: str) -> np.ndarray:
+    # reportlab and svglib take a while to import, and only the preview needs them
+    from reportlab.graphics import renderPM
+    from svglib.svglib import svg2rlg
+
     drawing = svg2rlg(StringIO(svg))
     png_buf = BytesIO()
     renderPM.drawToFile(drawing, png_buf, fmt="PNG")
@@ -1,11 +1,22 @@
 import logging
 import os
 import shutil
+import sqlite3
+import threading
+from dataclasses import dataclass, field
+from enum import Enum
 from pathlib import Path
-from typing import Optional
+from typing import TYPE_CHECKING, Optional
+
+import chess
+import chess.polyglot
 
 from utils.logger import create_logger
 
+# chess.engine imports asyncio, so it is only imported once an engine is used
+if TYPE_CHECKING:
+    import chess.engine
+
 logger = create_logger(name=__name__, level=logging.DEBUG)
 
 
@@ -38,3 +49,484 @@ def find_stockfish_binary(recursive: bool = False) -> Optional[Path]:
 
     logger.warning("Could not find stockfish binary")
     return None
+
+
+def find_opening_book() -> Optional[Path]:
+    """
+    Find a Polyglot opening book. Uses the CHESSBOT_OPENING_BOOK environment variable
+    if set, otherwise book.bin in the current directory.
+
+    :return: The path to the opening book, or None if it was not found.
+    """
+    path = Path(os.environ.get("CHESSBOT_OPENING_BOOK", Path.cwd() / "book.bin"))
+    if path.is_file():
+        logger.debug(f"Found opening book at {path}")
+        return path
+    logger.debug(f"No opening book at {path}")
+    return None
+
+
+def find_syzygy_tablebases() -> Optional[Path]:
+    """
+    Find a directory of Syzygy tablebases. Uses the CHESSBOT_SYZYGY_PATH environment
+    variable if set, otherwise the syzygy directory in the current directory.
+
+    :return: The path to the tablebase directory, or None if it was not found.
+    """
+    path = Path(os.environ.get("CHESSBOT_SYZYGY_PATH", Path.cwd() / "syzygy"))
+    if path.is_dir() and any(path.glob("*.rtbw")):
+        logger.debug(f"Found Syzygy tablebases at {path}")
+        return path
+    logger.debug(f"No Syzygy tablebases at {path}")
+    return None
+
+
+class SuggestionSource(Enum):
+    BOOK = "BOOK"
+    TABLEBASE = "TABLEBASE"
+    ENGINE = "ENGINE"
+
+
+@dataclass
+class EngineSuggestion:
+    move: Optional[chess.Move]
+    score: Optional["chess.engine.PovScore"]
+    depth: int
+    pv: list[chess.Move] = field(default_factory=list)
+    # Whether the search started before the position was reached, while pondering
+    pondered: bool = False
+    source: SuggestionSource = SuggestionSource.ENGINE
+    # Win (2), cursed win (1), draw (0), blessed loss (-1) or loss (-2) for the side
+    # to move, from tablebases
+    wdl: Optional[int] = None
+
+
+class PositionLookup:
+    def __init__(self, book_path: Optional[Path] = None,
+                 tablebase_path: Optional[Path] = None):
+        """
+        Answers positions exactly and instantly from a Polyglot opening book and
+        Syzygy tablebases, where they cover them.
+
+        :param book_path: Path to a Polyglot opening book, like from
+         find_opening_book.
+        :param tablebase_path: Path to a directory of Syzygy tablebases, like from
+         find_syzygy_tablebases.
+        """
+        import chess.syzygy
+
+        self._book = chess.polyglot.open_reader(book_path) \
+            if book_path is not None else None
+        self._tablebase = chess.syzygy.open_tablebase(str(tablebase_path)) \
+            if tablebase_path is not None else None
+        # Tables are named like KQvK
+        self._max_tablebase_pieces = max(
+            (len(name) - 1 for name in self._tablebase.wdl), default=0) \
+            if self._tablebase is not None else 0
+
+    def _lookup_book(self, board: chess.Board) -> Optional[EngineSuggestion]:
+        try:
+            entry = self._book.find(board)
+        except IndexError:
+            return None
+        return EngineSuggestion(move=entry.move, score=None, depth=0,
+                                pv=[entry.move], source=SuggestionSource.BOOK)
+
+    def _lookup_tablebase(self, board: chess.Board) -> Optional[EngineSuggestion]:
+        best_move = None
+        best_key = None
+        try:
+            for move in board.legal_moves:
+                zeroing = board.is_zeroing(move)
+                board.push(move)
+                try:
+                    wdl = -self._tablebase.probe_wdl(board)
+                    dtz = abs(self._tablebase.probe_dtz(board))
+                finally:
+                    board.pop()
+                # Win by resetting the 50 move counter as soon as possible, and lose
+                # as slowly as possible
+                key = (wdl, zeroing, -dtz) if wdl > 0 else (wdl, not zeroing, dtz)
+                if best_key is None or key > best_key:
+                    best_move, best_key = move, key
+        except KeyError:
+            # Missing table, or castling rights which tablebases do not cover
+            return None
+        if best_move is None:
+            return None
+        return EngineSuggestion(move=best_move, score=None, depth=0, pv=[best_move],
+                                source=SuggestionSource.TABLEBASE, wdl=best_key[0])
+
+    def lookup(self, board: chess.Board) -> Optional[EngineSuggestion]:
+        """
+        Look up the best move of a position in the opening book, then in the
+        tablebases.
+
+        :param board: The board.
+        :return: An EngineSuggestion with the source it came from, or None if the
+         position is not covered.
+        """
+        if self._book is not None and \
+                (suggestion := self._lookup_book(board)) is not None:
+            return suggestion
+        if self._tablebase is not None and \
+                chess.popcount(board.occupied) <= self._max_tablebase_pieces:
+            return self._lookup_tablebase(board)
+        return None
+
+    def close(self):
+        """
+        Close the opening book and tablebases.
+        """
+        if self._book is not None:
+            self._book.close()
+        if self._tablebase is not None:
+            self._tablebase.close()
+
+
+def get_position_key(board: chess.Board) -> int:
+    """
+    Get the Zobrist hash of a position as a signed 64-bit integer, which is what
+    SQLite can store.
+
+    :param board: The board.
+    :return: The signed Zobrist hash.
+    """
+    key = chess.polyglot.zobrist_hash(board)
+    return key - (1 << 64) if key >= (1 << 63) else key
+
+
+@dataclass
+class EngineEvaluationCacheMetrics:
+    hits: int = 0
+    misses: int = 0
+    writes: int = 0
+    evictions: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        """
+        Get the fraction of lookups that found an evaluation.
+
+        :return: The hit rate, or 0 if nothing was looked up yet.
+        """
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0
+
+
+class EngineEvaluationCache:
+    def __init__(self, path: Path, max_entries: int = 100_000):
+        """
+        Stores engine evaluations on disk, so positions that come up again do not
+        have to be searched from scratch. Safe to use from multiple threads.
+
+        :param path: Path to the SQLite database, which is created if it does not
+         exist.
+        :param max_entries: Maximum number of positions to keep. The least recently
+         used ones are evicted first. Defaults to 100000.
+        """
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(str(path), check_same_thread=False)
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS evaluations (
+                key INTEGER PRIMARY KEY,
+                depth INTEGER NOT NULL,
+                score_cp INTEGER,
+                score_mate INTEGER,
+                pv TEXT NOT NULL,
+                last_used INTEGER NOT NULL
+            )
+        """)
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS evaluations_last_used "
+            "ON evaluations (last_used)")
+        self._connection.commit()
+        self._clock = self._connection.execute(
+            "SELECT COALESCE(MAX(last_used), 0) FROM evaluations").fetchone()[0]
+        self._entries = self._connection.execute(
+            "SELECT COUNT(*) FROM evaluations").fetchone()[0]
+        self._metrics = EngineEvaluationCacheMetrics()
+        logger.debug(f"Opened engine evaluation cache at {path} with "
+                     f"{self._entries} positions")
+
+    def get(self, board: chess.Board) -> Optional[EngineSuggestion]:
+        """
+        Look up the evaluation of a position.
+
+        :param board: The board.
+        :return: An EngineSuggestion, or None if the position is not stored.
+        """
+        import chess.engine
+
+        key = get_position_key(board)
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT depth, score_cp, score_mate, pv FROM evaluations "
+                "WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self._metrics.misses += 1
+                return None
+            self._clock += 1
+            self._connection.execute(
+                "UPDATE evaluations SET last_used = ? WHERE key = ?",
+                (self._clock, key))
+            self._connection.commit()
+            self._metrics.hits += 1
+        depth, score_cp, score_mate, pv = row
+        if score_mate is not None:
+            score = chess.engine.PovScore(chess.engine.Mate(score_mate), board.turn)
+        elif score_cp is not None:
+            score = chess.engine.PovScore(chess.engine.Cp(score_cp), board.turn)
+        else:
+            score = None
+        pv = [chess.Move.from_uci(move) for move in pv.split()]
+        return EngineSuggestion(move=pv[0] if len(pv) > 0 else None, score=score,
+                                depth=depth, pv=pv)
+
+    def put(self, board: chess.Board, suggestion: EngineSuggestion):
+        """
+        Store the evaluation of a position, unless a deeper one is already stored.
+
+        :param board: The board.
+        :param suggestion: The evaluation, with the score from any point of view.
+        """
+        key = get_position_key(board)
+        score_cp = score_mate = None
+        if suggestion.score is not None:
+            score = suggestion.score.pov(board.turn)
+            if score.is_mate():
+                score_mate = score.mate()
+            else:
+                score_cp = score.score()
+        pv = " ".join(move.uci() for move in suggestion.pv)
+        with self._lock:
+            self._clock += 1
+            cursor = self._connection.execute(
+                "INSERT INTO evaluations VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET depth = excluded.depth, "
+                "score_cp = excluded.score_cp, score_mate = excluded.score_mate, "
+                "pv = excluded.pv, last_used = excluded.last_used "
+                "WHERE excluded.depth > evaluations.depth",
+                (key, suggestion.depth, score_cp, score_mate, pv, self._clock))
+            if cursor.rowcount > 0:
+                self._metrics.writes += 1
+                self._entries = self._connection.execute(
+                    "SELECT COUNT(*) FROM evaluations").fetchone()[0]
+                if self._entries > self._max_entries:
+                    self._evict()
+            self._connection.commit()
+
+    def _evict(self):
+        # Evict a tenth at a time, so evicting does not happen on every write
+        count = self._entries - int(self._max_entries * 0.9)
+        self._connection.execute(
+            "DELETE FROM evaluations WHERE key IN (SELECT key FROM evaluations "
+            "ORDER BY last_used LIMIT ?)", (count,))
+        self._entries -= count
+        self._metrics.evictions += count
+        logger.debug(f"Evicted {count} positions from the engine evaluation cache")
+
+    @property
+    def metrics(self) -> EngineEvaluationCacheMetrics:
+        """
+        Get the hit, miss, write and eviction counters of the cache.
+
+        :return: An EngineEvaluationCacheMetrics dataclass.
+        """
+        return self._metrics
+
+    def close(self):
+        """
+        Close the database.
+        """
+        with self._lock:
+            self._connection.close()
+
+
+class EngineAnalysisService:
+    def __init__(self, engine_path: Path, ponder: bool = True, ponder_depth: int = 16,
+                 max_depth: Optional[int] = None,
+                 cache: Optional[EngineEvaluationCache] = None,
+                 lookup: Optional[PositionLookup] = None):
+        """
+        Analyses positions with a UCI engine on a background thread, so the best move
+        found so far can be read at any time without blocking.
+
+        :param engine_path: Path to the engine binary, like from find_stockfish_binary.
+        :param ponder: Once the search of a position is deep enough, search the
+         position after its best move while the player thinks. If the player plays
+         that move, the search just continues.
+        :param ponder_depth: Depth at which to start pondering. Defaults to 16.
+        :param max_depth: Depth at which to stop searching, or None to search until
+         the position changes. Defaults to None.
+        :param cache: If given, positions stored at least as deep as max_depth, or
+         ponder_depth without max_depth, are not searched again, and searches are
+         written back to it when they end.
+        :param lookup: If given, positions in its opening book or tablebases are
+         answered from them without searching.
+        """
+        self._engine_path = engine_path
+        # Spawned on the background thread, so creating the service does not wait
+        # for the engine to start
+        self._engine: Optional["chess.engine.SimpleEngine"] = None
+        self._ponder = ponder
+        self._ponder_depth = ponder_depth
+        self._max_depth = max_depth
+        self._limit: Optional["chess.engine.Limit"] = None
+        self._cache = cache
+        self._lookup = lookup
+        self._cached_depth = max_depth or ponder_depth
+        self._condition = threading.Condition()
+        self._stopped = False
+        # The position the player is at
+        self._position: Optional[chess.Board] = None
+        self._position_key: Optional[int] = None
+        self._restart = False
+        # The position being searched, which is the position after the expected move
+        # when pondering
+        self._search_key: Optional[int] = None
+        self._pondering = False
+        self._analysis: Optional["chess.engine.SimpleAnalysisResult"] = None
+        self._suggestions: dict[int, EngineSuggestion] = {}
+        self._thread = threading.Thread(target=self._run, name="engine analysis",
+                                        daemon=True)
+        self._thread.start()
+
+    def set_position(self, board: chess.Board):
+        """
+        Set the position to analyse. Cheap to call every frame, since nothing happens
+        when the position did not change.
+
+        :param board: The board, which is copied.
+        """
+        key = chess.polyglot.zobrist_hash(board)
+        with self._condition:
+            if key == self._position_key:
+                return
+            self._position = board.copy()
+            self._position_key = key
+            if self._pondering and key == self._search_key:
+                logger.debug("Ponder hit, continuing search")
+                self._pondering = False
+                return
+            # Keep only the suggestion that might still be asked for
+            self._suggestions = {k: s for k, s in self._suggestions.items()
+                                 if k == key}
+            self._restart = True
+            if self._analysis is not None:
+                self._analysis.stop()
+            self._condition.notify()
+
+    def _run(self):
+        import chess.engine
+
+        logger.debug("Starting engine analysis")
+        self._limit = chess.engine.Limit(depth=self._max_depth) \
+            if self._max_depth else None
+        try:
+            self._engine = chess.engine.SimpleEngine.popen_uci(str(self._engine_path))
+        except (chess.engine.EngineError, OSError):
+            logger.exception("Could not start engine")
+            return
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._restart or self._stopped)
+                if self._stopped:
+                    break
+                self._restart = False
+                board = self._position.copy()
+            try:
+                expected_move = self._search(board, pondering=False)
+                while expected_move is not None:
+                    board.push(expected_move)
+                    logger.debug(f"Pondering on expected move {expected_move}")
+                    expected_move = self._search(board, pondering=True)
+            except chess.engine.EngineError:
+                logger.exception("Engine failed, stopping analysis")
+                break
+        logger.debug("Stopped engine analysis")
+
+    def _search(self, board: chess.Board,
+                pondering: bool) -> Optional[chess.Move]:
+        """
+        Search a position until it changes, the search is done, or it is time to
+        ponder.
+
+        :param board: The position to search.
+        :param pondering: Whether the position is the one after the expected move.
+        :return: The expected move to ponder on next, if any.
+        """
+        key = chess.polyglot.zobrist_hash(board)
+        known = self._lookup.lookup(board) if self._lookup is not None else None
+        cached = self._cache.get(board) \
+            if self._cache is not None and known is None else None
+        with self._condition:
+            if self._restart or self._stopped:
+                return None
+            if known is not None:
+                logger.debug(f"Found {known.move} in {known.source.value.lower()}")
+                known.pondered = pondering
+                self._suggestions[key] = known
+                if self._ponder and not pondering and key == self._position_key:
+                    return known.move
+                return None
+            if cached is not None:
+                cached.pondered = pondering
+                self._suggestions[key] = cached
+                if cached.depth >= self._cached_depth:
+                    logger.debug(f"Using cached evaluation at depth {cached.depth}")
+                    if self._ponder and not pondering and key == self._position_key:
+                        return cached.move
+                    return None
+            self._analysis = self._engine.analysis(board, self._limit)
+            self._search_key = key
+            self._pondering = pondering
+        expected_move = None
+        with self._analysis as analysis:
+            for info in analysis:
+                if "pv" not in info or "depth" not in info or \
+                        (cached is not None and info["depth"] <= cached.depth):
+                    continue
+                with self._condition:
+                    self._suggestions[key] = EngineSuggestion(
+                        move=info["pv"][0], score=info.get("score"),
+                        depth=info["depth"], pv=info["pv"],
+                        pondered=pondering)
+                    # Only ponder from the player's position, not ahead of it
+                    if self._ponder and not self._pondering and \
+                            key == self._position_key and \
+                            info["depth"] >= self._ponder_depth:
+                        expected_move = info["pv"][0]
+                        break
+        with self._condition:
+            self._analysis = None
+            self._search_key = None
+            self._pondering = False
+            suggestion = self._suggestions.get(key)
+        if self._cache is not None and suggestion is not None:
+            self._cache.put(board, suggestion)
+        return expected_move
+
+    @property
+    def suggestion(self) -> Optional[EngineSuggestion]:
+        """
+        Get the best move found so far for the current position, without blocking.
+
+        :return: An EngineSuggestion, or None if nothing was found yet.
+        """
+        with self._condition:
+            return self._suggestions.get(self._position_key)
+
+    def quit(self):
+        """
+        Stop analysing and close the engine.
+        """
+        with self._condition:
+            self._stopped = True
+            if self._analysis is not None:
+                self._analysis.stop()
+            self._condition.notify()
+        self._thread.join()
+        if self._engine is not None:
+            self._engine.close()
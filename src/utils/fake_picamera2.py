@@ -64,6 +64,15 @@ class FakePicamera2:
         """
         return self._max_image_index
 
+    @property
+    def image_path(self) -> Path:
+        """
+        Get the path of the current image.
+
+        :return: The path of the current image.
+        """
+        return self._image_paths[self._image_index]
+
     def capture_array(self) -> np.ndarray:
         path = str(self._image_paths[self._image_index].expanduser().resolve())
         logger.debug(f"Reading {path} (index {self._image_index}) into camera")
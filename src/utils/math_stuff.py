@@ -1,5 +1,9 @@
+from typing import TYPE_CHECKING
+
 import numpy as np
-from shapely.geometry.polygon import Polygon
+
+if TYPE_CHECKING:
+    from shapely.geometry.polygon import Polygon
 
 
 def angle_between_points(a, b, c):
@@ -29,7 +33,9 @@ def angle_between_points(a, b, c):
     return angle_degrees
 
 
-def find_closest_to_right_angles(polygon: Polygon) -> Polygon:
+def find_closest_to_right_angles(polygon: "Polygon") -> "Polygon":
+    from shapely.geometry.polygon import Polygon
+
     points = list(polygon.exterior.coords)[:-1]  # Exclude the repeated last point
     angles = []
 
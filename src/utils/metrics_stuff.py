@@ -0,0 +1,190 @@
+import logging
+import threading
+from bisect import bisect_left
+from typing import Iterable, Optional
+
+from utils.logger import create_logger
+
+logger = create_logger(name=__name__, level=logging.DEBUG)
+
+# From 0.5 ms to 10 s, which covers everything from a cached square lookup to a
+# board segmentation on a Pi
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10)
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, label: str,
+                 buckets: Iterable[float] = DEFAULT_BUCKETS):
+        """
+        A histogram with one label, like a latency per stage.
+
+        :param name: The metric name, like "chessbot_stage_seconds".
+        :param help: A description of the metric.
+        :param label: The name of the label, like "stage".
+        :param buckets: The upper bounds of the buckets, in increasing order.
+        """
+        self.name = name
+        self.help = help
+        self.label = label
+        self._buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # Label value to (count per bucket plus +Inf, sum, count)
+        self._values: dict[str, tuple[list[int], float, int]] = {}
+
+    def observe(self, label_value: str, value: float):
+        """
+        Record a value.
+
+        :param label_value: The value of the label, like "board".
+        :param value: The value, like a latency in seconds.
+        """
+        bucket = bisect_left(self._buckets, value)
+        with self._lock:
+            counts, total, count = self._values.get(
+                label_value, ([0] * (len(self._buckets) + 1), 0.0, 0))
+            counts[bucket] += 1
+            self._values[label_value] = (counts, total + value, count + 1)
+
+    def render(self) -> list[str]:
+        """
+        Render the histogram in the Prometheus text format.
+
+        :return: The lines of the histogram.
+        """
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            values = {label_value: (counts.copy(), total, count)
+                      for label_value, (counts, total, count) in self._values.items()}
+        for label_value, (counts, total, count) in sorted(values.items()):
+            labels = f'{self.label}="{label_value}"'
+            cumulative = 0
+            for bound, bucket_count in zip(self._buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                lines.append(f'{self.name}_bucket{{{labels},le="{le}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{labels}}} {total}")
+            lines.append(f"{self.name}_count{{{labels}}} {count}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, help: str, label: str,
+                 label_values: Iterable[str] = ()):
+        """
+        A counter with one label, like the number of frames per result.
+
+        :param name: The metric name, like "chessbot_frame_results_total".
+        :param help: A description of the metric.
+        :param label: The name of the label, like "result".
+        :param label_values: Label values to report as 0 before they are counted.
+        """
+        self.name = name
+        self.help = help
+        self.label = label
+        self._lock = threading.Lock()
+        self._values = {label_value: 0 for label_value in label_values}
+
+    def inc(self, label_value: str, amount: int = 1):
+        """
+        Increase the count of a label value.
+
+        :param label_value: The value of the label, like "OK".
+        :param amount: How much to increase the count by. Defaults to 1.
+        """
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def render(self) -> list[str]:
+        """
+        Render the counter in the Prometheus text format.
+
+        :return: The lines of the counter.
+        """
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = self._values.copy()
+        for label_value, count in sorted(values.items()):
+            lines.append(f'{self.name}{{{self.label}="{label_value}"}} {count}')
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        """
+        A collection of metrics that can be rendered together.
+        """
+        self._metrics: list[Histogram | Counter] = []
+
+    def register(self, metric: Histogram | Counter) -> Histogram | Counter:
+        """
+        Add a metric.
+
+        :param metric: The metric.
+        :return: The same metric.
+        """
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """
+        Render all metrics in the Prometheus text format.
+
+        :return: The text to serve.
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    def __init__(self, registry: MetricsRegistry, port: int,
+                 host: str = "127.0.0.1"):
+        """
+        Serves the metrics of a registry at /metrics on a background thread, for
+        Prometheus to scrape.
+
+        :param registry: The registry to serve.
+        :param port: The port to listen on.
+        :param host: The address to listen on. Defaults to only local connections.
+        """
+        # Only imported when serving, since http.server pulls in email and ssl
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """
+        Start serving.
+        """
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name="metrics server", daemon=True)
+        self._thread.start()
+        host, port = self._server.server_address[:2]
+        logger.info(f"Serving metrics at http://{host}:{port}/metrics")
+
+    def stop(self):
+        """
+        Stop serving.
+        """
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
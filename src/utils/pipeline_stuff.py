@@ -0,0 +1,162 @@
+import logging
+import threading
+from collections import deque
+from queue import Empty
+from time import perf_counter
+from typing import Any, Callable, Optional
+
+import numpy as np
+
+from utils.logger import create_logger
+
+logger = create_logger(name=__name__, level=logging.DEBUG)
+
+
+class DropOldestQueue:
+    def __init__(self, maxsize: int = 1):
+        """
+        A bounded queue that drops the oldest item instead of blocking when full, so
+        consumers always get the freshest items.
+
+        :param maxsize: Maximum number of items in the queue. Defaults to 1.
+        """
+        self._items = deque(maxlen=maxsize)
+        self._condition = threading.Condition()
+        self._dropped = 0
+
+    def put(self, item: Any):
+        """
+        Put an item in the queue, dropping the oldest item if the queue is full.
+
+        :param item: The item.
+        """
+        with self._condition:
+            if len(self._items) == self._items.maxlen:
+                self._dropped += 1
+            self._items.append(item)
+            self._condition.notify()
+
+    def get(self, timeout: Optional[float] = None) -> Any:
+        """
+        Get the oldest item in the queue, waiting for one if it is empty.
+
+        :param timeout: Maximum time in seconds to wait. Defaults to forever.
+        :return: The item.
+        :raises queue.Empty: If no item arrived in time.
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: len(self._items) > 0, timeout):
+                raise Empty
+            return self._items.popleft()
+
+    @property
+    def dropped(self) -> int:
+        """
+        Get the number of items dropped because the queue was full.
+
+        :return: The number of dropped items.
+        """
+        return self._dropped
+
+
+class StageStats:
+    def __init__(self, name: str):
+        """
+        Throughput and latency statistics of a pipeline stage.
+
+        :param name: The name of the stage.
+        """
+        self.name = name
+        self._started = perf_counter()
+        self._processed = 0
+        self._busy = 0.0
+        self._latencies = deque(maxlen=100)
+
+    def record(self, latency: float):
+        """
+        Record an item that went through the stage.
+
+        :param latency: How long the item took, in seconds.
+        """
+        self._processed += 1
+        self._busy += latency
+        self._latencies.append(latency)
+
+    @property
+    def processed(self) -> int:
+        """
+        Get the number of items that went through the stage.
+
+        :return: The number of items.
+        """
+        return self._processed
+
+    @property
+    def throughput(self) -> float:
+        """
+        Get the number of items per second that went through the stage.
+
+        :return: Items per second since the stage was created.
+        """
+        return self._processed / (perf_counter() - self._started)
+
+    def latency_percentile(self, percentile: float) -> float:
+        """
+        Get a percentile of the latency over the last 100 items.
+
+        :param percentile: The percentile, from 0 to 100.
+        :return: The latency in seconds, or 0 if there were no items.
+        """
+        if len(self._latencies) == 0:
+            return 0
+        return float(np.percentile(self._latencies, percentile))
+
+    def __str__(self) -> str:
+        return (f"{self.name}: {self.throughput:.1f}/s, "
+                f"p50 {self.latency_percentile(50) * 1000:.1f} ms, "
+                f"p95 {self.latency_percentile(95) * 1000:.1f} ms")
+
+
+class PipelineStage(threading.Thread):
+    def __init__(self, name: str, func: Callable[[Any], Any],
+                 input_queue: Optional[DropOldestQueue],
+                 output_queue: Optional[DropOldestQueue],
+                 stop_event: threading.Event):
+        """
+        A thread that takes items from an input queue, processes them and puts the
+        results in an output queue, until the stop event is set.
+
+        :param name: The name of the stage.
+        :param func: Processes an item. Gets None if there is no input queue, and may
+         return None to output nothing.
+        :param input_queue: Where to get items from, or None for a source stage.
+        :param output_queue: Where to put results, or None for a sink stage.
+        :param stop_event: Stops the stage when set. The stage sets it if func raises.
+        """
+        super().__init__(name=name, daemon=True)
+        self._func = func
+        self._input_queue = input_queue
+        self._output_queue = output_queue
+        self._stop_event = stop_event
+        self.stats = StageStats(name)
+
+    def run(self):
+        logger.debug(f"Starting {self.name} stage")
+        while not self._stop_event.is_set():
+            item = None
+            if self._input_queue is not None:
+                try:
+                    item = self._input_queue.get(timeout=0.1)
+                except Empty:
+                    continue
+            start = perf_counter()
+            try:
+                result = self._func(item)
+            except Exception:
+                logger.exception(f"Exception in {self.name} stage, stopping")
+                self._stop_event.set()
+                break
+            self.stats.record(perf_counter() - start)
+            if self._output_queue is not None and result is not None:
+                self._output_queue.put(result)
+        logger.debug(f"Stopped {self.name} stage")
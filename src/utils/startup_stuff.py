@@ -0,0 +1,155 @@
+import importlib.abc
+import sys
+import threading
+from dataclasses import dataclass
+from time import perf_counter
+from types import ModuleType
+from typing import Optional
+
+
+@dataclass
+class ImportTiming:
+    name: str
+    self_seconds: float
+    cumulative_seconds: float
+    depth: int
+    thread: str
+
+
+class _TimedLoader(importlib.abc.Loader):
+    def __init__(self, loader: importlib.abc.Loader, profiler: "ImportProfiler"):
+        self._loader = loader
+        self._profiler = profiler
+
+    def create_module(self, spec):
+        # Extension modules are loaded here rather than executed
+        self._profiler._enter(spec.name)
+        try:
+            if hasattr(self._loader, "create_module"):
+                return self._loader.create_module(spec)
+            return None
+        finally:
+            self._profiler._pause(spec.name)
+
+    def exec_module(self, module: ModuleType):
+        # Put the real loader back, in case anything looks at it later
+        module.__loader__ = self._loader
+        if module.__spec__ is not None:
+            module.__spec__.loader = self._loader
+        self._profiler._resume(module.__name__)
+        try:
+            self._loader.exec_module(module)
+        finally:
+            self._profiler._exit(module.__name__)
+
+    def __getattr__(self, name):
+        return getattr(self._loader, name)
+
+
+class ImportProfiler(importlib.abc.MetaPathFinder):
+    def __init__(self):
+        """
+        Times every module imported while it is installed, like python -X importtime,
+        including imports on other threads.
+        """
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.timings: list[ImportTiming] = []
+        self.installed_at: Optional[float] = None
+
+    def install(self):
+        """
+        Start timing imports. Install it before anything heavy is imported.
+        """
+        self.installed_at = perf_counter()
+        sys.meta_path.insert(0, self)
+
+    def uninstall(self):
+        """
+        Stop timing imports.
+        """
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+
+    def find_spec(self, fullname, path, target=None):
+        if getattr(self._local, "finding", False):
+            return None
+        self._local.finding = True
+        try:
+            for finder in sys.meta_path:
+                if finder is self or not hasattr(finder, "find_spec"):
+                    continue
+                spec = finder.find_spec(fullname, path, target)
+                if spec is not None:
+                    if spec.loader is not None and hasattr(spec.loader, "exec_module"):
+                        spec.loader = _TimedLoader(spec.loader, self)
+                    return spec
+            return None
+        finally:
+            self._local.finding = False
+
+    def _stack(self) -> list[list]:
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+            self._local.paused = {}
+        return self._local.stack
+
+    def _enter(self, name: str):
+        # Each entry is [name, start, seconds so far, seconds in child imports]
+        self._stack().append([name, perf_counter(), 0.0, 0.0])
+
+    def _pause(self, name: str):
+        # Between creating and executing a module, the import system does some
+        # bookkeeping that should not count towards the parent's own time
+        entry = self._stack().pop()
+        entry[2] += perf_counter() - entry[1]
+        self._local.paused[name] = entry
+
+    def _resume(self, name: str):
+        stack = self._stack()
+        entry = self._local.paused.pop(name, None) or [name, 0.0, 0.0, 0.0]
+        entry[1] = perf_counter()
+        stack.append(entry)
+
+    def _exit(self, name: str):
+        stack = self._stack()
+        entry = stack.pop()
+        cumulative = entry[2] + perf_counter() - entry[1]
+        if stack:
+            stack[-1][3] += cumulative
+        with self._lock:
+            self.timings.append(ImportTiming(
+                name=name, self_seconds=cumulative - entry[3],
+                cumulative_seconds=cumulative, depth=len(stack),
+                thread=threading.current_thread().name))
+
+    @property
+    def total_seconds(self) -> float:
+        """
+        Get the time spent importing, summed over threads.
+
+        :return: The total time of the top level imports in seconds.
+        """
+        with self._lock:
+            return sum(t.cumulative_seconds for t in self.timings if t.depth == 0)
+
+    def format(self, min_cumulative_seconds: float = 0.005) -> str:
+        """
+        Format the timings like python -X importtime, in the order imports finished,
+        leaving out imports that were quick with everything they imported.
+
+        :param min_cumulative_seconds: Only show imports that took at least this
+         long, including their own imports. Defaults to 5 ms.
+        :return: The breakdown, one import per line.
+        """
+        with self._lock:
+            timings = self.timings.copy()
+        lines = ["import time: self [ms] | cumulative | imported package"]
+        for timing in timings:
+            if timing.cumulative_seconds < min_cumulative_seconds:
+                continue
+            thread = f" ({timing.thread})" if timing.thread != "MainThread" else ""
+            lines.append(f"import time: {timing.self_seconds * 1000:9.1f} | "
+                         f"{timing.cumulative_seconds * 1000:10.1f} | "
+                         f"{'  ' * timing.depth}{timing.name}{thread}")
+        return "\n".join(lines)
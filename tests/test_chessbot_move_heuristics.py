@@ -0,0 +1,42 @@
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent / "src"))
+
+import chess
+
+from chessbot_move_heuristics import ChessbotMoveHeuristics
+from utils.chess_stuff import board_to_arrangement, find_chessboard_differences
+
+
+def get_gap_differences(board: chess.Board, sans: list[str]) -> list:
+    after = board.copy()
+    for san in sans:
+        after.push_san(san)
+    return find_chessboard_differences(board_to_arrangement(board),
+                                       board_to_arrangement(after))
+
+
+def test_catch_up_two_moves():
+    board = chess.Board()
+    differences = get_gap_differences(board, ["e4", "e5"])
+    moves = ChessbotMoveHeuristics(board).try_catch_up(differences)
+    assert moves == [chess.Move.from_uci("e2e4"), chess.Move.from_uci("e7e5")]
+    assert board.move_stack == moves
+
+
+def test_catch_up_dependent_moves():
+    # The bishop can only leave f1 after e4, so there is only one order
+    board = chess.Board()
+    differences = get_gap_differences(board, ["e4", "e5", "Bc4"])
+    moves = ChessbotMoveHeuristics(board).try_catch_up(differences)
+    assert moves == [chess.Move.from_uci(uci) for uci in ("e2e4", "e7e5", "f1c4")]
+    assert board.move_stack == moves
+
+
+def test_catch_up_rejects_transposable_gap():
+    # 1. Nf3 e5 2. e4 reaches the same position as 1. e4 e5 2. Nf3
+    board = chess.Board()
+    differences = get_gap_differences(board, ["e4", "e5", "Nf3"])
+    assert ChessbotMoveHeuristics(board).try_catch_up(differences) is None
+    assert board.move_stack == []